@@ -1,21 +1,37 @@
 import io
-import copy
 import logging
-import collections
+import collections.abc
 import contextlib
+from functools import partial
 import numpy as np
 from eight_mile.utils import optional_params, exporter, write_json, read_config_file, Offsets, mime_type
 
 __all__ = []
 export = exporter(__all__)
 logger = logging.getLogger("mead.layers")
+_OFFSET_SET = frozenset(Offsets.VALUES)
+_NORM_BLOCK_SIZE = 8192
+_READ_BLOCK_SIZE = 1024
+_WRITE_BLOCK_SIZE = 65536
 
 
 @export
-def norm_weights(word_vectors):
-    norms = np.linalg.norm(word_vectors, axis=1, keepdims=True)
-    norms = (norms == 0) + norms
-    return word_vectors / norms
+def norm_weights(word_vectors, copy=True):
+    """L2 normalize each row of the word vectors
+
+    :param word_vectors: A `(vsz, dsz)` array of word vectors
+    :param copy: (`bool`) If `False`, the input is normalized in-place and returned
+    :return: The normalized word vectors
+    """
+    if copy:
+        word_vectors = np.array(word_vectors)
+    # Work a block of rows at a time so each block is still in cache when we divide by its norms
+    for start in range(0, len(word_vectors), _NORM_BLOCK_SIZE):
+        block = word_vectors[start : start + _NORM_BLOCK_SIZE]
+        norms = np.sqrt(np.square(block).sum(axis=1, keepdims=True))
+        norms[norms == 0] = 1
+        np.divide(block, norms, out=block)
+    return word_vectors
 
 
 @export
@@ -37,16 +53,12 @@ def write_word2vec_file(filename, vocab, word_vectors):
 
     offset = 0
     # Check for case where we have a dict and possibly magic values to prune
-    if isinstance(vocab, collections.Mapping):
-        vocab_copy = copy.deepcopy(vocab)
-
-        for v in Offsets.VALUES:
-            if v in vocab_copy:
-                del vocab_copy[v]
-                offset += 1
-        vocab_list = [0] * len(vocab_copy)
-        for word, idx in vocab_copy.items():
-            vocab_list[idx - offset] = word
+    if isinstance(vocab, collections.abc.Mapping):
+        offset = sum(1 for v in _OFFSET_SET if v in vocab)
+        vocab_list = [0] * (len(vocab) - offset)
+        for word, idx in vocab.items():
+            if word not in _OFFSET_SET:
+                vocab_list[idx - offset] = word
     # Otherwise its just a list dont do anything weird
     else:
         vocab_list = vocab
@@ -59,9 +71,15 @@ def write_word2vec_file(filename, vocab, word_vectors):
         dsz = word_vectors[0].shape[0]
         f.write(bytes("{} {}\n".format(vsz, dsz), encoding="utf-8"))
         assert len(vocab_list) == len(word_vectors_offset)
-        for word, vector in zip(vocab_list, word_vectors_offset):
-            vec_str = vector.tobytes()
-            f.write(bytes("{} ".format(word), encoding="utf-8") + vec_str)
+        # Join a block of lines at a time so we issue one write per block instead of one per word
+        for start in range(0, vsz, _WRITE_BLOCK_SIZE):
+            end = start + _WRITE_BLOCK_SIZE
+            f.write(
+                b"".join(
+                    bytes("{} ".format(word), encoding="utf-8") + vector.tobytes()
+                    for word, vector in zip(vocab_list[start:end], word_vectors_offset[start:end])
+                )
+            )
 
 
 @export
@@ -105,7 +123,12 @@ class WordEmbeddingsModel(EmbeddingsModel):
             self.vsz = md["vsz"]
             self.dsz = md["dsz"]
         if "weights_file" in kwargs:
-            self.weights = np.load(kwargs["weights_file"]).get("arr_0")
+            # A .npy file can be memory-mapped so rows are only paged in when used, .npz members are always read
+            weights = np.load(kwargs["weights_file"], mmap_mode="r" if kwargs.get("use_mmap", False) else None)
+            if isinstance(weights, np.lib.npyio.NpzFile):
+                with weights:
+                    weights = weights["arr_0"]
+            self.weights = weights
 
         if self.weights is not None:
             if self.vsz is None:
@@ -118,7 +141,7 @@ class WordEmbeddingsModel(EmbeddingsModel):
                 assert self.dsz == self.weights.shape[1]
 
         elif self.vsz is not None and self.dsz is not None:
-            self.weights = np.zeros((self.vsz, self.dsz))
+            self.weights = np.zeros((self.vsz, self.dsz), dtype=np.float32)
 
     def get_dsz(self):
         return self.dsz
@@ -165,28 +188,26 @@ class PretrainedEmbeddingsModel(WordEmbeddingsModel):
         idx = Offsets.OFFSET
 
         word_vectors, self.dsz, known_vocab, idx = self._read_vectors(filename, idx, known_vocab, keep_unused, **kwargs)
-        self.nullv = np.zeros(self.dsz, dtype=np.float32)
-        special_tokens = [self.nullv]
-        for i in range(1, len(Offsets.VALUES)):
-            special_tokens.append(np.random.uniform(-uw, uw, self.dsz).astype(np.float32))
-        word_vectors = special_tokens + word_vectors
         # Add "well-known" values to the vocab
         for i, name in enumerate(Offsets.VALUES):
             self.vocab[name] = i
 
+        unknown = []
         if known_vocab is not None:
-            # Remove "well-known" values
-            for name in Offsets.VALUES:
-                known_vocab.pop(name, 0)
-            unknown = {v: cnt for v, cnt in known_vocab.items() if cnt > 0}
-            for v in unknown:
-                word_vectors.append(np.random.uniform(-uw, uw, self.dsz).astype(np.float32))
-                self.vocab[v] = idx
-                idx += 1
+            # Skip "well-known" values, they are already in the vocab
+            unknown = [v for v, cnt in known_vocab.items() if cnt > 0 and v not in _OFFSET_SET]
+
+        # Lay out the special tokens, the pretrained vectors and the unknown words in a single allocation
+        self.weights = np.empty((idx + len(unknown), self.dsz), dtype=np.float32)
+        self.nullv = np.zeros(self.dsz, dtype=np.float32)
+        self.weights[0] = self.nullv
+        self.weights[1 : len(Offsets.VALUES)] = np.random.uniform(-uw, uw, (len(Offsets.VALUES) - 1, self.dsz))
+        self.weights[Offsets.OFFSET : idx] = word_vectors
+        self.weights[idx:] = np.random.uniform(-uw, uw, (len(unknown), self.dsz))
+        self.vocab.update(zip(unknown, range(idx, idx + len(unknown))))
 
-        self.weights = np.array(word_vectors)
         if normalize is True:
-            self.weights = norm_weights(self.weights)
+            self.weights = norm_weights(self.weights, copy=False)
 
         self.vsz = self.weights.shape[0]
         assert self.weights.dtype == np.float32
@@ -202,128 +223,275 @@ class PretrainedEmbeddingsModel(WordEmbeddingsModel):
                 read_fn = self._read_word2vec_mmap
         elif is_glove_file:
             read_fn = self._read_text_file
+            workers = int(kwargs.get("workers", 1))
+            if workers > 1:
+                read_fn = partial(self._read_text_parallel, workers=workers)
 
         return read_fn(filename, idx, known_vocab, keep_unused)
 
     def _read_word2vec_file(self, filename, idx, known_vocab, keep_unused):
-        word_vectors = []
         with io.open(filename, "rb") as f:
             header = f.readline()
             vsz, dsz = map(int, header.split())
-            width = 4 * dsz
-            for i in range(vsz):
-                word = self._readtospc(f)
-                raw = f.read(width)
-                if word in self.vocab:
-                    continue
-                if keep_unused is False and word not in known_vocab:
-                    continue
-                if known_vocab and word in known_vocab:
-                    known_vocab[word] = 0
-                vec = np.fromstring(raw, dtype=np.float32)
-                word_vectors.append(vec)
-                self.vocab[word] = idx
-                idx += 1
+            # Read the rest of the file in one go and slice it, rather than reading each word and vector
+            payload = f.read()
+        word_vectors, idx = self._read_word2vec_buffer(payload, 0, vsz, dsz, idx, known_vocab, keep_unused)
         return word_vectors, dsz, known_vocab, idx
 
-    @staticmethod
-    def _read_word2vec_line_mmap(m, width, start):
-        current = start + 1
-        while m[current : current + 1] != b" ":
-            current += 1
-        vocab = m[start:current].decode("utf-8").strip(" \n")
-        raw = m[current + 1 : current + width + 1]
-        value = np.fromstring(raw, dtype=np.float32)
-        return vocab, value, current + width + 1
-
     def _read_word2vec_mmap(self, filename, idx, known_vocab, keep_unused):
         import mmap
 
-        word_vectors = []
         with io.open(filename, "rb") as f:
             with contextlib.closing(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) as m:
                 header_end = m[:50].find(b"\n")
                 vsz, dsz = map(int, (m[:header_end]).split(b" "))
-                width = 4 * dsz
-                current = header_end + 1
-                for i in range(vsz):
-                    word, vec, current = self._read_word2vec_line_mmap(m, width, current)
-                    if word in self.vocab:
-                        continue
-                    if keep_unused is False and word not in known_vocab:
-                        continue
-                    if known_vocab and word in known_vocab:
-                        known_vocab[word] = 0
-
-                    word_vectors.append(vec)
-                    self.vocab[word] = idx
-                    idx += 1
+                word_vectors, idx = self._read_word2vec_buffer(
+                    m, header_end + 1, vsz, dsz, idx, known_vocab, keep_unused
+                )
                 return word_vectors, dsz, known_vocab, idx
 
     @staticmethod
-    def _readtospc(f):
-
-        s = bytearray()
-        ch = f.read(1)
-
-        while ch != b" ":
-            s.extend(ch)
-            ch = f.read(1)
-        s = s.decode("utf-8")
-        # Only strip out normal space and \n not other spaces which are words.
-        return s.strip(" \n")
+    def _read_word2vec_offsets(buf, width, start, vsz):
+        """Locate each word in a word2vec payload
+
+        This only does the byte scanning, so the loop stays tight.  Decoding and vocab filtering happen afterwards
+
+        :param buf: The payload, `bytes` or an mmap
+        :param width: The width of each vector in bytes
+        :param start: The offset of the first word
+        :param vsz: The number of words in the file
+        :return: A list of offsets where each word starts and a list of offsets where each word ends
+        """
+        word_starts = [0] * vsz
+        word_ends = [0] * vsz
+        find = buf.find
+        for i in range(vsz):
+            end = find(b" ", start + 1)
+            word_starts[i] = start
+            word_ends[i] = end
+            start = end + 1 + width
+        return word_starts, word_ends
+
+    def _read_word2vec_buffer(self, buf, start, vsz, dsz, idx, known_vocab, keep_unused):
+        """Read the words and vectors out of a word2vec payload
+
+        :param buf: The payload, `bytes` or an mmap
+        :param start: The offset of the first word
+        :param vsz: The number of words in the file
+        :param dsz: The vector depth
+        :param idx: The index to assign to the first word we keep
+        :param known_vocab: The known vocab, updated in place
+        :param keep_unused: Should we keep words which are not in the `known_vocab`
+        :return: A `(kept, dsz)` `float32` array of the kept vectors and the next free index
+        """
+        width = 4 * dsz
+        offsets = []
+        word_starts, word_ends = self._read_word2vec_offsets(buf, width, start, vsz)
+        for word_start, word_end in zip(word_starts, word_ends):
+            word = buf[word_start:word_end].decode("utf-8").strip(" \n")
+            if word in self.vocab:
+                continue
+            if known_vocab and word in known_vocab:
+                known_vocab[word] = 0
+            elif keep_unused is False:
+                continue
+
+            offsets.append(word_end + 1)
+            self.vocab[word] = idx
+            idx += 1
+        # Take a single view over the whole payload and copy the kept vectors straight out of it
+        payload = np.frombuffer(buf, dtype=np.uint8)
+        word_vectors = np.empty((len(offsets), dsz), dtype=np.float32)
+        for row, offset in zip(word_vectors.view(np.uint8), offsets):
+            row[:] = payload[offset : offset + width]
+        # An mmap can't be closed while numpy still holds a view on it
+        del payload
+        return word_vectors, idx
 
     def _read_text_file(self, filename, idx, known_vocab, keep_unused):
-        word_vectors = []
+        vectors = _TextVectors()
 
         with io.open(filename, "r", encoding="utf-8") as f:
             for i, line in enumerate(f):
-                line = line.rstrip("\n ")
-                values = line.split(" ")
-                word = values[0]
-                if i == 0 and len(values) == 2:
-                    print("VSZ: {}, DSZ: {}".format(word, values[1]))
+                word, _, tail = line.rstrip("\n ").partition(" ")
+                if i == 0 and " " not in tail:
+                    print("VSZ: {}, DSZ: {}".format(word, tail))
+                    vectors.dsz = int(tail)
                     continue
+                vectors.read_dsz(tail)
                 if word in self.vocab:
                     continue
-                if keep_unused is False and word not in known_vocab or word in self.vocab:
-                    continue
                 if known_vocab and word in known_vocab:
                     known_vocab[word] = 0
-                vec = np.asarray(values[1:], dtype=np.float32)
-                word_vectors.append(vec)
+                elif keep_unused is False:
+                    continue
+                vectors.append(tail)
                 self.vocab[word] = idx
                 idx += 1
-        dsz = vec.shape[0]
-        return word_vectors, dsz, known_vocab, idx
+        word_vectors = vectors.finish()
+        if word_vectors is None:
+            raise ValueError("No vectors found in {}".format(filename))
+        return word_vectors, word_vectors.shape[1], known_vocab, idx
 
     def _read_text_mmap(self, filename, idx, known_vocab, keep_unused):
         import mmap
 
-        word_vectors = []
+        vectors = _TextVectors()
         with io.open(filename, "r", encoding="utf-8") as f:
             with contextlib.closing(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) as m:
                 for i, line in enumerate(iter(m.readline, b"")):
-                    line = line.rstrip(b"\n")
-                    values = line.split(b" ")
-                    if i == 0 and len(values) == 2:
-                        print("VSZ: {}, DSZ: {}".format(values[0], values[1]))
+                    word, _, tail = line.rstrip(b"\n").partition(b" ")
+                    if i == 0 and b" " not in tail:
+                        print("VSZ: {}, DSZ: {}".format(word, tail))
+                        vectors.dsz = int(tail)
                         continue
-                    if len(values) == 0:
-                        break
-                    word = values[0].decode("utf-8").strip(" \n")
+                    vectors.read_dsz(tail)
+                    word = word.decode("utf-8").strip(" \n")
                     if word in self.vocab:
                         continue
-                    if keep_unused is False and word not in known_vocab:
-                        continue
                     if known_vocab and word in known_vocab:
                         known_vocab[word] = 0
-                    vec = np.asarray(values[1:], dtype=np.float32)
-                    word_vectors.append(vec)
+                    elif keep_unused is False:
+                        continue
+                    vectors.append(tail)
                     self.vocab[word] = idx
                     idx += 1
-                dsz = vec.shape[0]
-                return word_vectors, dsz, known_vocab, idx
+        word_vectors = vectors.finish()
+        if word_vectors is None:
+            raise ValueError("No vectors found in {}".format(filename))
+        return word_vectors, word_vectors.shape[1], known_vocab, idx
+
+    def _read_text_parallel(self, filename, idx, known_vocab, keep_unused, workers):
+        """Read a text embeddings file by parsing byte ranges of it in a pool of processes
+
+        numpy's text parser holds the GIL, so this uses processes rather than threads.  They are spawned rather
+        than forked, since forking a process that already has a framework like TensorFlow (and its threads) loaded
+        is not safe.  Each worker returns the words and vectors for its range, and the vocab filtering is done here,
+        in file order, same as the sequential reader
+
+        :param workers: The number of processes to use
+        """
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        with io.open(filename, "rb") as f:
+            header = f.readline()
+            start = f.tell() if len(header.split()) == 2 else 0
+            end = f.seek(0, io.SEEK_END)
+            bounds = [start]
+            for i in range(1, workers):
+                f.seek(max(start + (end - start) * i // workers, bounds[-1]))
+                f.readline()
+                bounds.append(f.tell())
+            bounds.append(end)
+        dsz = None
+        if start > 0:
+            word, dsz = header.split()
+            print("VSZ: {}, DSZ: {}".format(word.decode("utf-8"), dsz.decode("utf-8")))
+            dsz = int(dsz)
+
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            chunks = list(executor.map(_read_text_range, [filename] * workers, bounds[:-1], bounds[1:]))
+
+        blocks = []
+        for words, vectors in chunks:
+            keep = []
+            for i, word in enumerate(words):
+                if word in self.vocab:
+                    continue
+                if known_vocab and word in known_vocab:
+                    known_vocab[word] = 0
+                elif keep_unused is False:
+                    continue
+                keep.append(i)
+                self.vocab[word] = idx
+                idx += 1
+            if vectors is not None:
+                dsz = vectors.shape[1]
+                blocks.append(vectors[keep])
+        if dsz is None:
+            raise ValueError("No vectors found in {}".format(filename))
+        word_vectors = np.concatenate(blocks) if blocks else np.empty((0, dsz), dtype=np.float32)
+        return word_vectors, dsz, known_vocab, idx
+
+
+class _TextVectors:
+    """Accumulate the vectors of a text embeddings file, parsing them a block of lines at a time
+
+    The text after the word on each kept line is collected, and every `_READ_BLOCK_SIZE` lines are parsed with a
+    single `np.fromstring` over their joined text.  The blocks are written into one `float32` buffer which doubles
+    its capacity when it fills up, so there is one allocation per doubling rather than one per word
+    """
+
+    def __init__(self):
+        self.tails = []
+        self.word_vectors = None
+        self.dsz = None
+        self.n = 0
+
+    def read_dsz(self, tail):
+        """Take the vector size from the text of the first vector, if there was no header giving it"""
+        if self.dsz is None:
+            self.dsz = len(tail.split())
+
+    def append(self, tail):
+        """Add the text of one vector, a `str` or `bytes` of space separated floats"""
+        self.read_dsz(tail)
+        self.tails.append(tail)
+        if len(self.tails) == _READ_BLOCK_SIZE:
+            self._parse()
+
+    def _parse(self):
+        if not self.tails:
+            return
+        sep = b" " if isinstance(self.tails[0], bytes) else " "
+        block = np.fromstring(sep.join(self.tails), dtype=np.float32, sep=" ")
+        if block.size != len(self.tails) * self.dsz:
+            raise ValueError("Every vector should have {} values".format(self.dsz))
+        block = block.reshape(len(self.tails), self.dsz)
+        self.tails = []
+        if self.word_vectors is None:
+            self.word_vectors = np.empty((_READ_BLOCK_SIZE, self.dsz), dtype=np.float32)
+        elif self.n + len(block) > len(self.word_vectors):
+            grown = np.empty((2 * len(self.word_vectors), self.dsz), dtype=np.float32)
+            grown[: self.n] = self.word_vectors[: self.n]
+            self.word_vectors = grown
+        self.word_vectors[self.n : self.n + len(block)] = block
+        self.n += len(block)
+
+    def finish(self):
+        """Parse whatever is left
+
+        :return: A `(n, dsz)` `float32` array of the vectors, which is empty if every vector was filtered out, or
+            `None` if the size of the vectors is unknown because there were none at all
+        """
+        self._parse()
+        if self.dsz is None:
+            return None
+        if self.word_vectors is None:
+            return np.empty((0, self.dsz), dtype=np.float32)
+        return self.word_vectors[: self.n]
+
+
+def _read_text_range(filename, start, end):
+    """Parse the lines of a text embeddings file between two byte offsets
+
+    :param filename: The text embeddings file
+    :param start: The offset of the first line to parse
+    :param end: The offset just past the last line to parse
+    :return: The words and a `(len(words), dsz)` `float32` array of the vectors, or `None` if there are no lines
+    """
+    words = []
+    vectors = _TextVectors()
+    with io.open(filename, "rb") as f:
+        f.seek(start)
+        for line in f.read(end - start).decode("utf-8").split("\n"):
+            word, _, tail = line.rstrip("\n ").partition(" ")
+            if not tail:
+                continue
+            vectors.append(tail)
+            words.append(word)
+    return words, vectors.finish()
 
 
 @export
@@ -338,9 +506,7 @@ class RandomInitVecModel(EmbeddingsModel):
         self.vsz = Offsets.OFFSET
 
         if counts is True:
-            for name in Offsets.VALUES:
-                known_vocab.pop(name, 0)
-            attested = [v for v, cnt in known_vocab.items() if cnt > 0]
+            attested = [v for v, cnt in known_vocab.items() if cnt > 0 and v not in _OFFSET_SET]
             for k, v in enumerate(attested):
                 self.vocab[v] = k + Offsets.OFFSET
                 self.vsz += 1
@@ -353,8 +519,7 @@ class RandomInitVecModel(EmbeddingsModel):
         self.nullv = np.zeros(self.dsz, dtype=np.float32)
 
         self.weights[0] = self.nullv
-        for i in range(1, len(Offsets.VALUES)):
-            self.weights[i] = np.random.uniform(-uw, uw, self.dsz).astype(np.float32)
+        self.weights[1 : len(Offsets.VALUES)] = np.random.uniform(-uw, uw, (len(Offsets.VALUES) - 1, self.dsz))
 
     def __getitem__(self, word):
         return self.lookup(word, nullifabsent=False)
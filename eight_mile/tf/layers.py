@@ -1,11 +1,14 @@
 import tensorflow as tf
 import numpy as np
-from eight_mile.utils import listify, Offsets, wraps, get_version, is_sequence
+from eight_mile.utils import listify, Offsets, wraps, get_version, is_sequence, optional_params
 from typing import Optional, Union, List, Dict, Any, Tuple
 
 import math
+import inspect
+from functools import lru_cache
 
 BASELINE_TF_TRAIN_FLAG = None
+TF_JIT_COMPILE = False
 
 
 def set_tf_log_level(ll):
@@ -36,6 +39,30 @@ def set_tf_log_level(ll):
     os.environ["TF_CPP_MIN_LOG_LEVEL"] = f"{tf_cpp_ll}"
 
 
+def set_tf_mixed_precision(policy: str = "mixed_bfloat16"):
+    """Opt in to mixed precision for the layers that are created after this call
+
+    Under `mixed_bfloat16` the activations and matmuls (e.g. in the attention and `FFN` layers) run in bfloat16 while
+    the variables stay in float32.  Unlike float16, bfloat16 keeps the float32 range, so no loss scaling is needed.
+    The attention softmax, the layer norm statistics and the `CRF` and `TaggerGreedyDecoder` still compute in float32
+
+    :param policy: The name of a keras mixed precision policy, `float32` turns it back off
+    """
+    tf.keras.mixed_precision.set_global_policy(policy)
+
+
+def set_tf_jit_compile(jit_compile: bool = True):
+    """Opt in to XLA compiling the traced calls of the layers that are created after this call
+
+    XLA compiles a fresh program for every new input shape, which only pays off once the shapes settle (e.g. bucketed
+    or fixed length batches), so it is off by default.  Layers that take a `jit_compile` argument can still override it
+
+    :param jit_compile: (``bool``) Should XLA compile the layers, `False` turns it back off
+    """
+    global TF_JIT_COMPILE
+    TF_JIT_COMPILE = jit_compile
+
+
 def SET_TRAIN_FLAG(X):
     global BASELINE_TF_TRAIN_FLAG
     BASELINE_TF_TRAIN_FLAG = X
@@ -62,6 +89,31 @@ def tensor_and_lengths(inputs):
     return in_tensor, lengths
 
 
+def trim_to_lengths(inputs, lengths):
+    """Slice the padding past the longest sequence off of a batch and build the mask for what is left
+
+    Batches are often padded out further than their longest sequence, and an RNN would step over all of it
+
+    :param inputs: A padded `[B, T, H]` tensor
+    :param lengths: The `[B]` sequence lengths, or `None`
+    :return: The (possibly) trimmed inputs and their mask, which is `None` if there are no lengths
+    """
+    if lengths is None:
+        return inputs, None
+    inputs = inputs[:, : tf.reduce_max(lengths)]
+    return inputs, tf.sequence_mask(lengths, tf.shape(inputs)[1])
+
+
+def pad_to_length(outputs, length):
+    """Zero-pad the time dimension of a `[B, T, H]` tensor back out to `length`
+
+    :param outputs: A `[B, T, H]` tensor
+    :param length: The length to pad out to
+    :return: A `[B, length, H]` tensor
+    """
+    return tf.pad(outputs, [[0, 0], [0, length - tf.shape(outputs)[1]], [0, 0]])
+
+
 # Get rid of this?
 def new_placeholder_dict(train):
     global BASELINE_TF_TRAIN_FLAG
@@ -71,27 +123,52 @@ def new_placeholder_dict(train):
     return {}
 
 
+@optional_params
+def tf_function(func, jit_compile: Optional[bool] = False, input_signature: Optional[List[tf.TensorSpec]] = None):
+    """Trace a function (or a layer's method) into a `tf.function`, optionally compiling it with XLA
+
+    Under TF 1.x everything is already built into a graph, so the function is returned as is.  The input shapes
+    are relaxed so that a new batch size or sequence length doesn't cause a retrace.  Anything that should change
+    the trace, like the training flag, needs to be an argument of the function rather than read from a global
+
+    :param func: The function to trace
+    :param jit_compile: (``bool``) Should XLA compile the function.  If `None`, follow `set_tf_jit_compile` as it is
+        when the function is created, so layers wrap their methods with this in `__init__` instead of decorating them
+    :param input_signature: An optional signature to trace once for, instead of tracing on the first call
+    :return: The traced function
+    """
+    if get_version(tf) < 2:
+        return func
+    if jit_compile is None:
+        jit_compile = TF_JIT_COMPILE
+    params = inspect.signature(tf.function).parameters
+    kwargs = {"reduce_retracing" if "reduce_retracing" in params else "experimental_relax_shapes": True}
+    if input_signature is not None:
+        kwargs["input_signature"] = input_signature
+    if jit_compile:
+        kwargs["jit_compile" if "jit_compile" in params else "experimental_compile"] = True
+    return tf.function(func, **kwargs)
+
+
 def gelu(x):
-    return 0.5 * x * (1 + tf.tanh(math.sqrt(2 / math.pi) * (x + 0.044715 * tf.pow(x, 3))))
+    if hasattr(tf.nn, "gelu"):
+        return tf.nn.gelu(x, approximate=True)
+    return 0.5 * x * (1 + tf.tanh(math.sqrt(2 / math.pi) * (x + 0.044715 * x * x * x)))
 
 
 def swish(x):
-    return x * tf.nn.sigmoid(x)
+    return tf.nn.swish(x)
 
 
 def masked_fill(t, mask, value):
-    return t * (1 - tf.cast(mask, t.dtype)) + value * tf.cast(mask, t.dtype)
+    # The v2 `where` broadcasts the mask (a single select op) under TF 1.x as well
+    return tf.compat.v2.where(tf.cast(mask, tf.bool), tf.cast(value, t.dtype), t)
 
 
 # https://stackoverflow.com/questions/41897212/how-to-sort-a-multi-dimensional-tensor-using-the-returned-indices-of-tf-nn-top-k
 def gather_k(a, b, best_idx, k):
-    shape_a = get_shape_as_list(a)
-    auxiliary_indices = tf.meshgrid(
-        *[tf.range(d) for d in (tf.unstack(shape_a[: (a.get_shape().ndims - 1)]) + [k])], indexing="ij"
-    )
-
-    sorted_b = tf.gather_nd(b, tf.stack(auxiliary_indices[:-1] + [best_idx], axis=-1))
-    return sorted_b
+    # Every leading dim is a batch dim, so there is no need for a meshgrid of indices to `gather_nd` with
+    return tf.gather(b, best_idx, batch_dims=a.get_shape().ndims - 1)
 
 
 def get_shape_as_list(x):
@@ -107,9 +184,11 @@ def get_shape_as_list(x):
     try:
         ps = x.get_shape().as_list()
     except:
-        ps = x.shape
-    ts = tf.shape(x)
-    return [ts[i] if ps[i] is None else ps[i] for i in range(len(ps))]
+        ps = list(x.shape)
+    if all(p is not None for p in ps):
+        return ps
+    ts = tf.unstack(tf.shape(x), num=len(ps))
+    return [t if p is None else p for t, p in zip(ts, ps)]
 
 
 def bth2bht(t):
@@ -132,24 +211,21 @@ def bth2tbh(t):
     return t.transpose(t, [1, 0, 2])
 
 
+_ACTIVATIONS = {
+    None: tf.identity,
+    "ident": tf.identity,
+    "softmax": tf.nn.softmax,
+    "tanh": tf.nn.tanh,
+    "sigmoid": tf.nn.sigmoid,
+    "gelu": gelu,
+    "swish": swish,
+    "leaky_relu": tf.nn.leaky_relu,
+}
+
+
 # Mapped
 def get_activation(name: str = "relu"):
-    if name is None or name == "ident":
-        return tf.nn.identity
-    if name == "softmax":
-        return tf.nn.softmax
-    if name == "tanh":
-        return tf.nn.tanh
-    if name == "sigmoid":
-        return tf.nn.sigmoid
-    if name == "gelu":
-        return gelu
-    if name == "swish":
-        return swish
-        return tf.identity
-    if name == "leaky_relu":
-        return tf.nn.leaky_relu
-    return tf.nn.relu
+    return _ACTIVATIONS.get(name, tf.nn.relu)
 
 
 # Mapped
@@ -159,11 +235,18 @@ class ConvEncoder(tf.keras.layers.Layer):
         self.output_dim = outsz
         self.conv = tf.keras.layers.Conv1D(filters=outsz, kernel_size=filtsz, padding="same")
         self.act = get_activation(activation)
-        self.dropout = tf.keras.layers.Dropout(pdrop)
+        self.dropout = tf.keras.layers.Dropout(pdrop) if pdrop > 0 else None
+        self._call = tf_function(jit_compile=None)(self._call)
 
     def call(self, inputs):
+        # Without dropout the train flag changes nothing, so don't trace a second copy when it flips
+        return self._call(inputs, TRAIN_FLAG() if self.dropout is not None else False)
+
+    def _call(self, inputs, training):
         conv_out = self.act(self.conv(inputs))
-        return self.dropout(conv_out, TRAIN_FLAG())
+        if self.dropout is None:
+            return conv_out
+        return self.dropout(conv_out, training)
 
 
 # Mapped
@@ -174,22 +257,26 @@ class ConvEncoderStack(tf.keras.layers.Layer):
         super().__init__()
 
         first_layer = ConvEncoder(insz, outsz, filtsz, pdrop, activation)
-        self.layers.append(first_layer)
-        for i in range(layers - 1):
-            subsequent_layer = ResidualBlock(ConvEncoder(insz, outsz, filtsz, pdrop, activation))
-            self.layers.append(subsequent_layer)
+        subsequent_layers = [
+            ResidualBlock(ConvEncoder(outsz, outsz, filtsz, pdrop, activation)) for _ in range(layers - 1)
+        ]
+        self.net = tf.keras.Sequential([first_layer] + subsequent_layers)
+        self.output_dim = outsz
+        self.pdrop = pdrop
+        self._call = tf_function(jit_compile=None)(self._call)
 
     def call(self, x):
-        for layer in self.layers:
-            x = layer(x)
-        return x
+        return self._call(x, TRAIN_FLAG() if self.pdrop > 0 else False)
+
+    def _call(self, x, training):
+        # `training` isn't used directly (each `ConvEncoder` reads the flag), but it keys the trace on the flag
+        return self.net(x)
 
 
 # Mapped
 class ParallelConv(tf.keras.layers.Layer):
-    DUMMY_AXIS = 1
-    TIME_AXIS = 2
-    FEATURE_AXIS = 3
+    TIME_AXIS = 1
+    FEATURE_AXIS = 2
 
     def __init__(
         self,
@@ -198,17 +285,22 @@ class ParallelConv(tf.keras.layers.Layer):
         filtsz: List[int],
         activation: str = "relu",
         name: Optional[str] = None,
+        dtype=None,
         **kwargs,
     ):
         """Do parallel convolutions with multiple filter widths and max-over-time pooling.
 
+        The convolutions run in the layer's compute dtype, so passing `tf.float16`, `tf.bfloat16` or a mixed precision
+        policy like `"mixed_float16"` runs them at half precision.  The pooled result is always cast back to `float32`
+
         :param insz: The input size (not required, can pass `None`)
         :param outsz: The output size(s).  Normally this is an int, but it can be a stack of them
         :param filtsz: The list of filter widths to use.
         :param activation: (``str``) The name of the activation function to use (`default='relu`)
         :param name: An optional name
+        :param dtype: The dtype or mixed precision policy for the layer, defaults to the global policy
         """
-        super().__init__(name=name)
+        super().__init__(name=name, dtype=dtype)
         self.Ws = []
         self.bs = []
         self.activation = get_activation(activation)
@@ -224,22 +316,32 @@ class ParallelConv(tf.keras.layers.Layer):
                 self.add_weight("cmot-{}/b".format(fsz), shape=[cmotsz], initializer=tf.constant_initializer(0.0))
             )
 
+        # To run all the filters as a single conv, each one gets zero-padded out to the widest filter.  It has to
+        # sit where `SAME` padding would center it, so that every filter still sees the same window as before.
+        # The kernels keep their leading dummy axis (so checkpoints still line up) but the conv itself is 1D
+        max_fsz = max(int(fsz) for fsz in filtsz)
+        self.paddings = []
+        for fsz in filtsz:
+            left = (max_fsz - 1) // 2 - (int(fsz) - 1) // 2
+            self.paddings.append([[left, max_fsz - int(fsz) - left], [0, 0], [0, 0]])
         self.output_dim = sum(motsz)
+        # Everything but `B` and `T` is fixed here, so trace (and compile, see `set_tf_jit_compile`) for that up front
+        signature = [tf.TensorSpec([None, None, insz], self.compute_dtype)]
+        self._specialized_call = tf_function(jit_compile=None, input_signature=signature)(self._call)
 
     def call(self, inputs):
         """
         :param inputs: The inputs in the shape [B, T, H].
         :return: Combined result
         """
-        mots = []
-        expanded = tf.expand_dims(inputs, ParallelConv.DUMMY_AXIS)
-        for W, b in zip(self.Ws, self.bs):
-            conv = tf.nn.conv2d(expanded, W, strides=[1, 1, 1, 1], padding="SAME", name="CONV")
-            activation = self.activation(tf.nn.bias_add(conv, b), "activation")
-            mot = tf.reduce_max(activation, [ParallelConv.TIME_AXIS], keepdims=True)
-            mots.append(mot)
-        combine = tf.reshape(tf.concat(values=mots, axis=ParallelConv.FEATURE_AXIS), [-1, self.output_dim])
-        return combine
+        return self._specialized_call(inputs)
+
+    def _call(self, inputs):
+        W = tf.concat([tf.pad(W[0], paddings) for W, paddings in zip(self.Ws, self.paddings)], -1)
+        b = tf.concat(self.bs, 0)
+        conv = tf.nn.conv1d(inputs, W, stride=1, padding="SAME", name="CONV")
+        activation = self.activation(tf.nn.bias_add(conv, b))
+        return tf.cast(tf.reduce_max(activation, ParallelConv.TIME_AXIS), tf.float32)
 
     def compute_output_shape(self, input_shape):
         return input_shape[0], self.output_dim
@@ -263,6 +365,30 @@ def lstm_cell(hsz: int, forget_bias: float = 1.0, **kwargs):
     return tf.nn.rnn_cell.ResidualWrapper(cell) if skip_conn else cell
 
 
+def lstm_layer(hsz: int, pdrop: float = 0.0, variational: bool = False, **kwargs):
+    """Produce a Keras LSTM layer that TF can run on the fused cuDNN kernel
+
+    The cuDNN path is only taken with the default activations, a bias, no unrolling and no recurrent dropout, so
+    these are pinned here.  Variational dropout needs recurrent dropout, so those layers fall back to the generic kernel
+
+    :param hsz: (``int``) The number of hidden units
+    :param pdrop: (``float``) The probability of dropping a unit value during dropout
+    :param variational: (``bool``) variational recurrence is on
+    :return: a `tf.keras.layers.LSTM`
+    """
+    return tf.keras.layers.LSTM(
+        hsz,
+        activation="tanh",
+        recurrent_activation="sigmoid",
+        use_bias=True,
+        unit_forget_bias=True,
+        unroll=False,
+        recurrent_dropout=pdrop if variational else 0.0,
+        dropout=pdrop if not variational else 0.0,
+        **kwargs,
+    )
+
+
 def lstm_cell_w_dropout(
     hsz: int, pdrop: float, forget_bias: float = 1.0, variational: bool = False, training: bool = False, **kwargs
 ):
@@ -322,25 +448,10 @@ class LSTMEncoder2(tf.keras.layers.Layer):
         self._requires_length = requires_length
         self.rnns = []
         for _ in range(nlayers - 1):
-            self.rnns.append(
-                tf.keras.layers.LSTM(
-                    hsz,
-                    return_sequences=True,
-                    recurrent_dropout=pdrop if variational else 0.0,
-                    dropout=pdrop if not variational else 0.0,
-                )
-            )
+            self.rnns.append(lstm_layer(hsz, pdrop, variational, return_sequences=True))
         if nlayers == 1 and not dropout_in_single_layer and not variational:
             pdrop = 0.0
-        self.rnns.append(
-            tf.keras.layers.LSTM(
-                hsz,
-                return_sequences=True,
-                return_state=True,
-                recurrent_dropout=pdrop if variational else 0.0,
-                dropout=pdrop if not variational else 0.0,
-            )
-        )
+        self.rnns.append(lstm_layer(hsz, pdrop, variational, return_sequences=True, return_state=True))
 
     def output_fn(self, output, state):
         """Returns back the output sequence of an RNN and hidden state
@@ -352,13 +463,19 @@ class LSTMEncoder2(tf.keras.layers.Layer):
         return output, state
 
     def call(self, inputs):
+        return self._call(inputs, TRAIN_FLAG())
+
+    @tf_function
+    def _call(self, inputs, training):
+        # Keras would otherwise read the training mode at trace time, so the flag is an argument to key the trace on
         inputs, lengths = tensor_and_lengths(inputs)
-        mask = tf.sequence_mask(lengths)
+        T = tf.shape(inputs)[1]
+        inputs, mask = trim_to_lengths(inputs, lengths)
         for rnn in self.rnns:
-            outputs = rnn(inputs, mask=mask)
+            outputs = rnn(inputs, mask=mask, training=training)
             inputs = outputs
         rnnout, h, c = outputs
-        return self.output_fn(rnnout, (h, c))
+        return self.output_fn(pad_to_length(rnnout, T), (h, c))
 
     @property
     def requires_length(self) -> bool:
@@ -384,26 +501,10 @@ class LSTMEncoderWithState2(tf.keras.layers.Layer):
         self.hsz = hsz
         self.rnns = []
         for _ in range(nlayers - 1):
-            self.rnns.append(
-                tf.keras.layers.LSTM(
-                    hsz,
-                    return_sequences=True,
-                    return_state=True,
-                    recurrent_dropout=pdrop if variational else 0.0,
-                    dropout=pdrop if not variational else 0.0,
-                )
-            )
+            self.rnns.append(lstm_layer(hsz, pdrop, variational, return_sequences=True, return_state=True))
         if nlayers == 1 and not dropout_in_single_layer and not variational:
             pdrop = 0.0
-        self.rnns.append(
-            tf.keras.layers.LSTM(
-                hsz,
-                return_sequences=True,
-                return_state=True,
-                recurrent_dropout=pdrop if variational else 0.0,
-                dropout=pdrop if not variational else 0.0,
-            )
-        )
+        self.rnns.append(lstm_layer(hsz, pdrop, variational, return_sequences=True, return_state=True))
         self.requires_state = True
 
     def call(self, inputs):
@@ -414,6 +515,10 @@ class LSTMEncoderWithState2(tf.keras.layers.Layer):
         :param inputs:
         :return:
         """
+        return self._call(inputs, TRAIN_FLAG())
+
+    @tf_function
+    def _call(self, inputs, training):
         inputs, hidden_state_input = inputs
 
         hidden_outputs = []
@@ -422,20 +527,15 @@ class LSTMEncoderWithState2(tf.keras.layers.Layer):
             if hidden_state_input is not None:
                 hidden_state = hidden_state_input[i]
                 initial_state = (hidden_state[0], hidden_state[1])
-            outputs, h, c = rnn(inputs, initial_state=initial_state)
+            outputs, h, c = rnn(inputs, initial_state=initial_state, training=training)
             hidden_outputs.append((h, c))
             inputs = outputs
         return outputs, hidden_outputs
 
     def zero_state(self, batchsz: int):
-        num_rnns = len(self.rnns)
-        zstate = []
-        for i, _ in enumerate(self.rnns):
-            zstate.append(
-                (np.zeros((batchsz, num_rnns), dtype=np.float32), np.zeros((batchsz, num_rnns), dtype=np.float32))
-            )
-
-        return zstate
+        # Tensors are immutable so every layer can share the same zeros for both `h` and `c`
+        zeros = tf.zeros((batchsz, self.hsz), dtype=tf.float32)
+        return [(zeros, zeros) for _ in self.rnns]
 
 
 class LSTMEncoderSequence2(LSTMEncoder2):
@@ -568,6 +668,7 @@ class LSTMEncoder1(tf.keras.layers.Layer):
         dropout_in_single_layer: bool = False,
         skip_conn: bool = False,
         projsz: Optional[int] = None,
+        use_cudnn: bool = False,
         **kwargs,
     ):
         """Produce a stack of LSTMs with dropout performed on all but the last layer.
@@ -579,12 +680,19 @@ class LSTMEncoder1(tf.keras.layers.Layer):
         :param output_fn: A function that filters output to decide what to return
         :param requires_length: (``bool``) Does the input require an input length (defaults to ``True``)
         :param name: (``str``) Optional, defaults to `None`
+        :param use_cudnn: (``bool``) Run the whole stack as one fused `CudnnLSTM` (GPU only).  This is ignored for
+            variational dropout, dropout in the last layer, skip connections and projections, which cuDNN doesn't do.
+            The weights are stored in cuDNN's format, so checkpoints don't carry over between the two
         :return: a stacked cell
         """
         super().__init__(name=name)
         self._requires_length = requires_length
+        self.use_cudnn = use_cudnn and not (variational or dropout_in_single_layer or skip_conn or projsz)
 
-        if variational or dropout_in_single_layer:
+        if self.use_cudnn:
+            # cuDNN drops out the outputs of every layer but the last, same as the cells below
+            self.rnn = tf.contrib.cudnn_rnn.CudnnLSTM(nlayers, hsz, dropout=pdrop)
+        elif variational or dropout_in_single_layer:
             self.rnn = tf.contrib.rnn.MultiRNNCell(
                 [
                     lstm_cell_w_dropout(
@@ -607,11 +715,28 @@ class LSTMEncoder1(tf.keras.layers.Layer):
 
     def call(self, inputs):
         inputs, lengths = tensor_and_lengths(inputs)
+        if self.use_cudnn:
+            return self._call_cudnn(inputs, lengths)
         with tf.name_scope(self.name), tf.variable_scope(self.name):
             rnnout, hidden = tf.nn.dynamic_rnn(self.rnn, inputs, sequence_length=lengths, dtype=tf.float32)
         state = (hidden[-1].h, hidden[-1].c)
         return self.output_fn(rnnout, state)
 
+    def _call_cudnn(self, inputs, lengths):
+        # cuDNN wants `[T, B, H]`, and `training` has to be a python bool, so the train flag picks a branch
+        inputs = tf.transpose(inputs, [1, 0, 2])
+
+        def run(training):
+            return lambda: self.rnn(inputs, sequence_lengths=lengths, training=training)
+
+        with tf.name_scope(self.name), tf.variable_scope(self.name):
+            # Create the weights before branching, so they aren't made inside (and owned by) one branch of the cond
+            if not self.rnn.built:
+                with tf.variable_scope(self.rnn.name):
+                    self.rnn.build(inputs.get_shape())
+            rnnout, (h, c) = tf.contrib.framework.smart_cond(TRAIN_FLAG(), run(True), run(False))
+        return self.output_fn(tf.transpose(rnnout, [1, 0, 2]), (h[-1], c[-1]))
+
     def output_fn(self, output, state):
         """Returns back the output sequence of an RNN and hidden state
 
@@ -767,6 +892,8 @@ class LSTMEncoderWithState1(LSTMEncoder1):
         dropout_in_single_layer: bool = True,
         **kwargs,
     ):
+        # The state is threaded through `dynamic_rnn` from `zero_state`, which needs the cells
+        kwargs.pop("use_cudnn", None)
         super().__init__(
             insz=insz,
             hsz=hsz,
@@ -821,23 +948,11 @@ class LSTMEncoderAll2(tf.keras.layers.Layer):
         self._requires_length = requires_length
         self.rnns = []
         for _ in range(nlayers - 1):
-            rnn = tf.keras.layers.LSTM(
-                hsz,
-                return_sequences=True,
-                return_state=True,
-                recurrent_dropout=pdrop if variational else 0.0,
-                dropout=pdrop if not variational else 0.0,
-            )
+            rnn = lstm_layer(hsz, pdrop, variational, return_sequences=True, return_state=True)
             self.rnns.append(rnn)
         if nlayers == 1 and not dropout_in_single_layer and not variational:
             pdrop = 0.0
-        rnn = tf.keras.layers.LSTM(
-            hsz // 2,
-            return_sequences=True,
-            return_state=True,
-            recurrent_dropout=pdrop if variational else 0.0,
-            dropout=pdrop if not variational else 0.0,
-        )
+        rnn = lstm_layer(hsz // 2, pdrop, variational, return_sequences=True, return_state=True)
 
         # This concat mode only works on the sequences, we still are getting 4 objects back for the state
         self.rnns.append(rnn)
@@ -846,21 +961,26 @@ class LSTMEncoderAll2(tf.keras.layers.Layer):
         return rnnout, state
 
     def call(self, inputs):
+        return self._call(inputs, TRAIN_FLAG())
+
+    @tf_function
+    def _call(self, inputs, training):
         inputs, lengths = tensor_and_lengths(inputs)
-        mask = tf.sequence_mask(lengths)
+        T = tf.shape(inputs)[1]
+        inputs, mask = trim_to_lengths(inputs, lengths)
         # (num_layers * num_directions, batch, hidden_size):
         ## TODO: how to combine this?
         hs = []
         cs = []
         for rnn in self.rnns:
-            outputs, h, c = rnn(inputs, mask=mask)
+            outputs, h, c = rnn(inputs, mask=mask, training=training)
             hs.append(h)
             cs.append(c)
             inputs = outputs
 
         h = tf.stack(hs)
         c = tf.stack(cs)
-        return self.output_fn(outputs, (h, c))
+        return self.output_fn(pad_to_length(outputs, T), (h, c))
 
     @property
     def requires_length(self):
@@ -898,23 +1018,11 @@ class BiLSTMEncoderAll2(tf.keras.layers.Layer):
         self._requires_length = requires_length
         self.rnns = []
         for _ in range(nlayers - 1):
-            rnn = tf.keras.layers.LSTM(
-                hsz // 2,
-                return_sequences=True,
-                return_state=True,
-                recurrent_dropout=pdrop if variational else 0.0,
-                dropout=pdrop if not variational else 0.0,
-            )
+            rnn = lstm_layer(hsz // 2, pdrop, variational, return_sequences=True, return_state=True)
             self.rnns.append(tf.keras.layers.Bidirectional(rnn))
         if nlayers == 1 and not dropout_in_single_layer and not variational:
             pdrop = 0.0
-        rnn = tf.keras.layers.LSTM(
-            hsz // 2,
-            return_sequences=True,
-            return_state=True,
-            recurrent_dropout=pdrop if variational else 0.0,
-            dropout=pdrop if not variational else 0.0,
-        )
+        rnn = lstm_layer(hsz // 2, pdrop, variational, return_sequences=True, return_state=True)
 
         # This concat mode only works on the sequences, we still are getting 4 objects back for the state
         self.rnns.append(tf.keras.layers.Bidirectional(rnn, merge_mode="concat"))
@@ -923,23 +1031,25 @@ class BiLSTMEncoderAll2(tf.keras.layers.Layer):
         return rnnout, state
 
     def call(self, inputs):
+        return self._call(inputs, TRAIN_FLAG())
+
+    @tf_function
+    def _call(self, inputs, training):
         inputs, lengths = tensor_and_lengths(inputs)
-        mask = tf.sequence_mask(lengths)
+        T = tf.shape(inputs)[1]
+        inputs, mask = trim_to_lengths(inputs, lengths)
         # (num_layers * num_directions, batch, hidden_size):
         hs = []
         cs = []
         for rnn in self.rnns:
-            outputs, h1, c1, h2, c2 = rnn(inputs, mask=mask)
-            h = tf.stack([h1, h2])
-            c = tf.stack([c1, c2])
-            hs.append(h)
-            cs.append(c)
+            outputs, h1, c1, h2, c2 = rnn(inputs, mask=mask, training=training)
+            hs.append(tf.concat([h1, h2], -1))
+            cs.append(tf.concat([c1, c2], -1))
             inputs = outputs
 
-        _, B, H = get_shape_as_list(h)
-        h = tf.reshape(tf.stack(hs), [-1, B, H * 2])
-        c = tf.reshape(tf.stack(cs), [-1, B, H * 2])
-        return self.output_fn(outputs, (h, c))
+        h = tf.stack(hs)
+        c = tf.stack(cs)
+        return self.output_fn(pad_to_length(outputs, T), (h, c))
 
     @property
     def requires_length(self) -> bool:
@@ -978,22 +1088,11 @@ class BiLSTMEncoder2(tf.keras.layers.Layer):
         self._requires_length = requires_length
         self.rnns = []
         for _ in range(nlayers - 1):
-            rnn = tf.keras.layers.LSTM(
-                hsz // 2,
-                return_sequences=True,
-                recurrent_dropout=pdrop if variational else 0.0,
-                dropout=pdrop if not variational else 0.0,
-            )
+            rnn = lstm_layer(hsz // 2, pdrop, variational, return_sequences=True)
             self.rnns.append(tf.keras.layers.Bidirectional(rnn))
         if nlayers == 1 and not dropout_in_single_layer and not variational:
             pdrop = 0.0
-        rnn = tf.keras.layers.LSTM(
-            hsz // 2,
-            return_sequences=True,
-            return_state=True,
-            recurrent_dropout=pdrop if variational else 0.0,
-            dropout=pdrop if not variational else 0.0,
-        )
+        rnn = lstm_layer(hsz // 2, pdrop, variational, return_sequences=True, return_state=True)
 
         # This concat mode only works on the sequences, we still are getting 4 objects back for the state
         self.rnns.append(tf.keras.layers.Bidirectional(rnn, merge_mode="concat"))
@@ -1002,14 +1101,19 @@ class BiLSTMEncoder2(tf.keras.layers.Layer):
         return rnnout, state
 
     def call(self, inputs):
+        return self._call(inputs, TRAIN_FLAG())
+
+    @tf_function
+    def _call(self, inputs, training):
         inputs, lengths = tensor_and_lengths(inputs)
-        mask = tf.sequence_mask(lengths)
+        T = tf.shape(inputs)[1]
+        inputs, mask = trim_to_lengths(inputs, lengths)
         for rnn in self.rnns:
-            outputs = rnn(inputs, mask=mask)
+            outputs = rnn(inputs, mask=mask, training=training)
             inputs = outputs
 
         rnnout, h_fwd, c_fwd, h_bwd, c_bwd = outputs
-        return self.output_fn(rnnout, ((h_fwd, c_fwd), (h_bwd, c_bwd)))
+        return self.output_fn(pad_to_length(rnnout, T), ((h_fwd, c_fwd), (h_bwd, c_bwd)))
 
     @property
     def requires_length(self):
@@ -1128,6 +1232,7 @@ class BiLSTMEncoder1(tf.keras.layers.Layer):
         name: Optional[str] = None,
         skip_conn: bool = False,
         projsz: Optional[int] = None,
+        use_cudnn: bool = False,
         **kwargs,
     ):
         """Produce a stack of LSTMs with dropout performed on all but the last layer.
@@ -1137,65 +1242,100 @@ class BiLSTMEncoder1(tf.keras.layers.Layer):
         :param pdrop: (``int``) The probability of dropping a unit value during dropout
         :param variational (``bool``) variational recurrence is on
         :param training (``bool``) Are we training? (defaults to ``False``)
+        :param use_cudnn: (``bool``) Run both directions of the whole stack as one fused `CudnnLSTM` (GPU only).
+            This is ignored for variational dropout, skip connections and projections.  The weights are stored in
+            cuDNN's format, so checkpoints don't carry over between the two
         :return: a stacked cell
         """
         super().__init__(name=name)
         self._requires_length = requires_length
         self.layers = nlayers
         hsz = hsz // 2
-        if variational:
-            self.fwd_rnn = tf.contrib.rnn.MultiRNNCell(
-                [
-                    lstm_cell_w_dropout(
-                        hsz, pdrop, variational=variational, training=TRAIN_FLAG(), skip_conn=skip_conn, projsz=projsz
-                    )
-                    for _ in range(nlayers)
-                ],
-                state_is_tuple=True,
-            )
-            self.bwd_rnn = tf.contrib.rnn.MultiRNNCell(
-                [
-                    lstm_cell_w_dropout(
-                        hsz, pdrop, variational=variational, training=TRAIN_FLAG(), skip_conn=skip_conn, projsz=projsz
-                    )
-                    for _ in range(nlayers)
-                ],
-                state_is_tuple=True,
-            )
+        self.use_cudnn = use_cudnn and not (variational or skip_conn or projsz)
+        if self.use_cudnn:
+            self.rnn = tf.contrib.cudnn_rnn.CudnnLSTM(nlayers, hsz, direction="bidirectional", dropout=pdrop)
         else:
+            training = TRAIN_FLAG()
             self.fwd_rnn = tf.contrib.rnn.MultiRNNCell(
-                [
-                    lstm_cell_w_dropout(hsz, pdrop, training=TRAIN_FLAG(), skip_conn=skip_conn, projsz=projsz)
-                    if i < nlayers - 1
-                    else lstm_cell(hsz, skip_conn=skip_conn, projsz=projsz)
-                    for i in range(nlayers)
-                ],
-                state_is_tuple=True,
+                self._make_cells(hsz, nlayers, pdrop, variational, skip_conn, projsz, training), state_is_tuple=True
             )
             self.bwd_rnn = tf.contrib.rnn.MultiRNNCell(
-                [
-                    lstm_cell_w_dropout(hsz, pdrop, training=TRAIN_FLAG(), skip_conn=skip_conn, projsz=projsz)
-                    if i < nlayers - 1
-                    else lstm_cell(hsz)
-                    for i in range(nlayers)
-                ],
-                state_is_tuple=True,
+                self._make_cells(hsz, nlayers, pdrop, variational, skip_conn, projsz, training), state_is_tuple=True
             )
 
+    @staticmethod
+    def _make_cells(
+        hsz: int,
+        nlayers: int,
+        pdrop: float,
+        variational: bool,
+        skip_conn: bool,
+        projsz: Optional[int],
+        training: bool,
+    ) -> List:
+        """Build the cells for one direction of the stack
+
+        With variational dropout every layer is wrapped (the mask is sampled once per sequence), otherwise the
+        last layer has no dropout
+
+        :param hsz: (``int``) The number of hidden units per LSTM
+        :param nlayers: (``int``) The number of layers of LSTMs to stack
+        :param pdrop: (``float``) The probability of dropping a unit value during dropout
+        :param variational: (``bool``) variational recurrence is on
+        :param skip_conn: (``bool``) Add residual connections around each cell
+        :param projsz: (``int``) An optional projection size for each cell
+        :param training: (``bool``) Are we training?
+        :return: A list of cells
+        """
+        cells = []
+        for i in range(nlayers):
+            if variational or i < nlayers - 1:
+                cell = lstm_cell_w_dropout(
+                    hsz, pdrop, variational=variational, training=training, skip_conn=skip_conn, projsz=projsz
+                )
+            else:
+                cell = lstm_cell(hsz, skip_conn=skip_conn, projsz=projsz)
+            cells.append(cell)
+        return cells
+
     def output_fn(self, rnnout, state):
         return rnnout, state
 
     def call(self, inputs):
         inputs, lengths = tensor_and_lengths(inputs)
-        with tf.name_scope(self.name), tf.variable_scope(self.name):
-            rnnout, (fwd_state, backward_state) = tf.nn.bidirectional_dynamic_rnn(
-                self.fwd_rnn, self.bwd_rnn, inputs, sequence_length=lengths, dtype=tf.float32
-            )
-        rnnout = tf.concat(axis=2, values=rnnout)
+        if self.use_cudnn:
+            rnnout, (fwd_state, backward_state) = self._call_cudnn(inputs, lengths)
+        else:
+            with tf.name_scope(self.name), tf.variable_scope(self.name):
+                rnnout, (fwd_state, backward_state) = tf.nn.bidirectional_dynamic_rnn(
+                    self.fwd_rnn, self.bwd_rnn, inputs, sequence_length=lengths, dtype=tf.float32
+                )
+            rnnout = tf.concat(axis=2, values=rnnout)
         return self.output_fn(
             rnnout, ((fwd_state[-1].h, fwd_state[-1].c), (backward_state[-1].h, backward_state[-1].c))
         )
 
+    def _call_cudnn(self, inputs, lengths):
+        """Run the fused stack, giving back the same structure as `bidirectional_dynamic_rnn` (with the output
+        directions already concatenated)
+        """
+        # cuDNN wants `[T, B, H]`, and `training` has to be a python bool, so the train flag picks a branch
+        inputs = tf.transpose(inputs, [1, 0, 2])
+
+        def run(training):
+            return lambda: self.rnn(inputs, sequence_lengths=lengths, training=training)
+
+        with tf.name_scope(self.name), tf.variable_scope(self.name):
+            # Create the weights before branching, so they aren't made inside (and owned by) one branch of the cond
+            if not self.rnn.built:
+                with tf.variable_scope(self.rnn.name):
+                    self.rnn.build(inputs.get_shape())
+            rnnout, (h, c) = tf.contrib.framework.smart_cond(TRAIN_FLAG(), run(True), run(False))
+        # The states come back as `[L * 2, B, H]`, each layer's forward direction followed by its backward one
+        fwd_state = [tf.contrib.rnn.LSTMStateTuple(c=c[i], h=h[i]) for i in range(0, 2 * self.layers, 2)]
+        bwd_state = [tf.contrib.rnn.LSTMStateTuple(c=c[i], h=h[i]) for i in range(1, 2 * self.layers, 2)]
+        return tf.transpose(rnnout, [1, 0, 2]), (fwd_state, bwd_state)
+
     @property
     def requires_length(self) -> bool:
         return self._requires_length
@@ -1204,10 +1344,13 @@ class BiLSTMEncoder1(tf.keras.layers.Layer):
 class BiLSTMEncoderAll1(BiLSTMEncoder1):
     def call(self, inputs):
         inputs, lengths = tensor_and_lengths(inputs)
-        rnnout, (fwd_state, bwd_state) = tf.nn.bidirectional_dynamic_rnn(
-            self.fwd_rnn, self.bwd_rnn, inputs, sequence_length=lengths, dtype=tf.float32
-        )
-        rnnout = tf.concat(axis=2, values=rnnout)
+        if self.use_cudnn:
+            rnnout, (fwd_state, bwd_state) = self._call_cudnn(inputs, lengths)
+        else:
+            rnnout, (fwd_state, bwd_state) = tf.nn.bidirectional_dynamic_rnn(
+                self.fwd_rnn, self.bwd_rnn, inputs, sequence_length=lengths, dtype=tf.float32
+            )
+            rnnout = tf.concat(axis=2, values=rnnout)
         encoder_state = []
         for i in range(self.layers):
             h = tf.concat([fwd_state[i].h, bwd_state[i].h], -1)
@@ -1380,6 +1523,7 @@ class EmbeddingsStack(tf.keras.layers.Layer):
         self.embeddings = embeddings_dict
         self.dropout = tf.keras.layers.Dropout(dropout_rate)
         self._requires_length = requires_length
+        self._concat_and_dropout = tf_function(jit_compile=None)(self._concat_and_dropout)
 
     def items(self):
         return self.embeddings.items()
@@ -1395,8 +1539,12 @@ class EmbeddingsStack(tf.keras.layers.Layer):
             x = inputs[k]
             embeddings_out = embedding(x)
             all_embeddings_out.append(embeddings_out)
+        return self._concat_and_dropout(all_embeddings_out, TRAIN_FLAG())
+
+    def _concat_and_dropout(self, all_embeddings_out, training):
+        # Compiled together (see `set_tf_jit_compile`), XLA writes the concatenated embeddings and their dropout in a single pass
         word_embeddings = tf.concat(values=all_embeddings_out, axis=-1)
-        return self.dropout(word_embeddings, TRAIN_FLAG())
+        return self.dropout(word_embeddings, training)
 
     @property
     def dsz(self) -> int:
@@ -1427,18 +1575,14 @@ class WeightTieDense(tf.keras.layers.Layer):
             return
         W = getattr(self.tied, "W", None)
         if W is not None:
-            self.W = w
+            self.W = W
             super().build(input_shape)
             return
         self.W = getattr(self.tied, "kernel")
-        super().build()
+        super().build(input_shape)
 
     def call(self, inputs):
-        shape = tf.shape(inputs)
-        inputs = tf.reshape(inputs, [-1, shape[-1]])
-        outs = tf.matmul(inputs, self.W, transpose_b=True)
-        new_shape = tf.concat([shape[:-1], tf.constant([-1])], axis=0)
-        return tf.reshape(outs, new_shape)
+        return tf.einsum("...d,vd->...v", inputs, self.W)
 
 
 class DenseStack(tf.keras.layers.Layer):
@@ -1464,6 +1608,7 @@ class DenseStack(tf.keras.layers.Layer):
         hszs = listify(hsz)
         self.layer_stack = [tf.keras.layers.Dense(hsz, kernel_initializer=init, activation=activation) for hsz in hszs]
         self.dropout = tf.keras.layers.Dropout(pdrop_value)
+        self._call = tf_function(jit_compile=None)(self._call)
 
     def call(self, inputs):
         """Stack 1 or more hidden layers, optionally (forming an MLP)
@@ -1478,10 +1623,14 @@ class DenseStack(tf.keras.layers.Layer):
 
         :return: The final layer
         """
+        return self._call(inputs, TRAIN_FLAG())
+
+    def _call(self, inputs, training):
+        # Compiled as one block, XLA can fuse each layer's bias, activation and dropout into its matmul epilogue
         x = inputs
         for layer in self.layer_stack:
             x = layer(x)
-            x = self.dropout(x, TRAIN_FLAG())
+            x = self.dropout(x, training)
         return x
 
     @property
@@ -1510,12 +1659,16 @@ class Highway(tf.keras.layers.Layer):
         self.transform = tf.keras.layers.Dense(
             input_size, bias_initializer=tf.keras.initializers.Constant(value=-2.0), activation="sigmoid"
         )
+        self._call = tf_function(jit_compile=None)(self._call)
 
     def call(self, inputs):
+        return self._call(inputs)
+
+    def _call(self, inputs):
         proj_result = self.proj(inputs)
         proj_gate = self.transform(inputs)
-        gated = (proj_gate * proj_result) + ((1 - proj_gate) * inputs)
-        return gated
+        # Same as `g * proj + (1 - g) * inputs`, with one less multiply
+        return proj_gate * (proj_result - inputs) + inputs
 
     @property
     def requires_length(self):
@@ -1542,7 +1695,7 @@ class SkipConnection(ResidualBlock):
 
 class TimeDistributedProjection(tf.keras.layers.Layer):
     def __init__(self, num_outputs, name=None):
-        """Set up a low-order projection (embedding) by flattening the batch and time dims and matmul
+        """Set up a low-order projection (embedding) over the last dim of the input
 
         TODO: Avoid where possible, Dense should work in most cases
 
@@ -1562,16 +1715,12 @@ class TimeDistributedProjection(tf.keras.layers.Layer):
         super().build(input_shape)
 
     def call(self, inputs):
-        """Low-order projection (embedding) by flattening the batch and time dims and matmul
+        """Low-order projection (embedding) over the last dim, contracted in place without flattening the batch
 
         :param inputs: The input tensor
         :return: An output tensor having the same dims as the input, except the last which is `output_dim`
         """
-        input_shape = get_shape_as_list(inputs)
-        collapse = tf.reshape(inputs, [-1, input_shape[-1]])
-        c = tf.matmul(collapse, self.W) + self.b
-        c = tf.reshape(c, input_shape[:-1] + [self.output_dim])
-        return c
+        return tf.einsum("...d,dv->...v", inputs, self.W) + self.b
 
     def compute_output_shape(self, input_shape):
         return input_shape[0], self.output_dim
@@ -1581,6 +1730,22 @@ class TimeDistributedProjection(tf.keras.layers.Layer):
         return False
 
 
+def attention_softmax(scores, mask=None, name=None):
+    """Mask out the scores where `mask == 0` and softmax them
+
+    This is safe under a mixed precision policy: the scores are masked with a value that `float16` can hold, and the
+    softmax itself is done in `float32` before casting back to the dtype of the scores
+
+    :param scores: The attention scores [B, H, T, T]
+    :param mask: An optional mask that broadcasts against the scores
+    :param name: An optional name for the softmax
+    :return: The attention weights, in the same dtype as the scores
+    """
+    if mask is not None:
+        scores = masked_fill(scores, mask == 0, tf.float16.min if scores.dtype == tf.float16 else -1e9)
+    return tf.cast(tf.nn.softmax(tf.cast(scores, tf.float32), name=name), scores.dtype)
+
+
 class SequenceSequenceAttention(tf.keras.layers.Layer):
     def __init__(self, hsz: Optional[int] = None, pdrop: float = 0.1, name: str = None):
         super().__init__(name=name)
@@ -1614,6 +1779,7 @@ class SequenceSequenceAttention(tf.keras.layers.Layer):
 class SeqScaledDotProductAttention(SequenceSequenceAttention):
     def __init__(self, pdrop: float = 0.1, name: str = "scaled_dot_product_attention", **kwargs):
         super().__init__(pdrop, name=name, **kwargs)
+        self._attention = tf_function(jit_compile=None)(self._attention)
 
     def _attention(self, query, key, mask=None):
         """Scaled dot product attention, as defined in https://arxiv.org/abs/1706.03762
@@ -1627,15 +1793,42 @@ class SeqScaledDotProductAttention(SequenceSequenceAttention):
         :param mask: masking (for destination) to prevent seeing what we shouldnt
         :return: A tensor that is (BxHxTxT)
         """
-        # Check why this was set to 2 before
-        d_k = tf.shape(query)[-1]
+        # Scale the query rather than the scores, it is [B, H, T, D] instead of [B, H, T, T]
+        d_k = get_shape_as_list(query)[-1]
+        query *= 1.0 / math.sqrt(d_k) if isinstance(d_k, int) else tf.math.rsqrt(tf.cast(d_k, query.dtype))
         scores = tf.matmul(query, key, transpose_b=True)
-        scores *= tf.math.rsqrt(tf.cast(d_k, tf.float32))
+        # Compiled, XLA folds the mask fill into the softmax instead of writing the masked scores out in between
+        return attention_softmax(scores, mask, name="attention_weights")
 
-        if mask is not None:
-            scores = masked_fill(scores, mask == 0, -1e9)
 
-        return tf.nn.softmax(scores, name="attention_weights")
+def relative_edge_scores(query, edges_key):
+    """Score each query against the relative position representation of each key
+
+    :param query: The queries `[B, H, T, D]`
+    :param edges_key: The `[T, T, D]` key edge representations, or a `(table, one_hot_edges)` pair of the `[R, D]`
+        embedding table and the `[T, T, R]` one-hot relative positions
+    :return: The `[B, H, T, T]` scores
+    """
+    if isinstance(edges_key, (list, tuple)):
+        # Score against the R table rows once, then pick out each (i, j) pair's row, rather than gathering [T, T, D]
+        table, one_hot_edges = edges_key
+        scores = tf.einsum("bhid,rd->bhir", query, tf.cast(table, query.dtype))
+        return tf.einsum("bhir,ijr->bhij", scores, tf.cast(one_hot_edges, query.dtype))
+    return tf.einsum("bhid,ijd->bhij", query, edges_key)
+
+
+def relative_edge_values(a, edges_value):
+    """Apply attention weights to the relative position representations of the values
+
+    :param a: The attention weights `[B, H, T, T]`
+    :param edges_value: The `[T, T, D]` value edge representations, or a `(table, one_hot_edges)` pair
+    :return: The `[B, H, T, D]` weighted edge values
+    """
+    if isinstance(edges_value, (list, tuple)):
+        table, one_hot_edges = edges_value
+        weights = tf.einsum("bhij,ijr->bhir", a, tf.cast(one_hot_edges, a.dtype))
+        return tf.einsum("bhir,rd->bhid", weights, tf.cast(table, a.dtype))
+    return tf.einsum("bhij,ijd->bhid", a, edges_value)
 
 
 class SequenceSequenceRelativeAttention(tf.keras.layers.Layer):
@@ -1666,16 +1859,11 @@ class SequenceSequenceRelativeAttention(tf.keras.layers.Layer):
 
         :param a: The attention weights [B, H, T, T]
         :param value: The values [B, H, T, D]
-        :param edge_value: The edge values [T, T, D]
+        :param edge_value: The edge values [T, T, D], or a `(table, one_hot_edges)` pair
         :returns: A tensor of shape [B, H, T, D]
         """
-        B, H, T, D = get_shape_as_list(value)
         updated_values = tf.matmul(a, value)
-        # (T, BxH, T)
-        a = tf.transpose(tf.reshape(a, [B * H, T, T]), [1, 0, 2])
-        t = tf.matmul(a, edges_value)  # (T, BxH, D)
-        t = tf.transpose(t, [1, 0, 2])
-        update_edge_values = tf.reshape(t, [B, H, T, D])
+        update_edge_values = relative_edge_values(a, edges_value)
         return updated_values + update_edge_values
 
 
@@ -1693,23 +1881,19 @@ class SeqScaledDotProductRelativeAttention(SequenceSequenceRelativeAttention):
         :param query: a query for alignment. Can come from self in case of self-attn or decoder in case of E/D
         :param key: a set of keys from encoder or self
         :param mask: masking (for destination) to prevent seeing what we shouldnt
-        :param edges_key: a matrix of relative embeddings between each word in a sequence [TxTxD]
+        :param edges_key: a matrix of relative embeddings between each word in a sequence [TxTxD], or a
+            `(table, one_hot_edges)` pair
         :return: A tensor that is (BxHxTxT)
         """
         # (., H, T, T) = (., H, T, D) x (., H, D, T)
-        B, H, T, d_k = get_shape_as_list(query)
+        # Scale the query rather than the scores, it is [B, H, T, D] instead of [B, H, T, T]
+        d_k = get_shape_as_list(query)[-1]
+        query *= 1.0 / math.sqrt(d_k) if isinstance(d_k, int) else tf.math.rsqrt(tf.cast(d_k, query.dtype))
         scores_qk = tf.matmul(query, key, transpose_b=True)
+        scores_qek = relative_edge_scores(query, edges_key)
+        scores = scores_qk + scores_qek
 
-        tbhd = tf.transpose(tf.reshape(query, [B * H, T, d_k]), [1, 0, 2])
-        scores_qek = tf.matmul(tbhd, edges_key, transpose_b=True)
-        scores_qek = tf.transpose(scores_qek, [1, 0, 2])
-        scores_qek = tf.reshape(scores_qek, [B, H, T, T])
-        scores = (scores_qk + scores_qek) / math.sqrt(d_k)
-
-        if mask is not None:
-            scores = masked_fill(scores, mask == 0, -1e9)
-
-        return tf.nn.softmax(scores, name="rel_attention_weights")
+        return attention_softmax(scores, mask, name="rel_attention_weights")
 
 
 class SeqDotProductRelativeAttention(SequenceSequenceRelativeAttention):
@@ -1726,23 +1910,16 @@ class SeqDotProductRelativeAttention(SequenceSequenceRelativeAttention):
         :param query: a query for alignment. Can come from self in case of self-attn or decoder in case of E/D
         :param key: a set of keys from encoder or self
         :param mask: masking (for destination) to prevent seeing what we shouldnt
-        :param edges_key: a matrix of relative embeddings between each word in a sequence [TxTxD]
+        :param edges_key: a matrix of relative embeddings between each word in a sequence [TxTxD], or a
+            `(table, one_hot_edges)` pair
         :return: A tensor that is (BxHxTxT)
         """
         # (., H, T, T) = (., H, T, D) x (., H, D, T)
-        B, H, T, d_k = get_shape_as_list(query)
         scores_qk = tf.matmul(query, key, transpose_b=True)
-
-        tbhd = tf.transpose(tf.reshape(query, [B * H, T, d_k]), [1, 0, 2])
-        scores_qek = tf.matmul(tbhd, edges_key, transpose_b=True)
-        scores_qek = tf.transpose(scores_qek, [1, 0, 2])
-        scores_qek = tf.reshape(scores_qek, [B, H, T, T])
+        scores_qek = relative_edge_scores(query, edges_key)
         scores = scores_qk + scores_qek
 
-        if mask is not None:
-            scores = masked_fill(scores, mask == 0, -1e9)
-
-        return tf.nn.softmax(scores, name="rel_attention_weights")
+        return attention_softmax(scores, mask, name="rel_attention_weights")
 
 
 class SeqDotProductAttention(SequenceSequenceAttention):
@@ -1752,10 +1929,216 @@ class SeqDotProductAttention(SequenceSequenceAttention):
     def _attention(self, query, key, mask=None):
         scores = tf.matmul(query, key, transpose_b=True)
 
+        return attention_softmax(scores, mask, name="attention_weights")
+
+
+class SeqBlockwiseDotProductAttention(SequenceSequenceAttention):
+    def __init__(
+        self,
+        pdrop: float = 0.1,
+        block_size: int = 128,
+        scale: bool = True,
+        causal: bool = False,
+        name: str = "blockwise_attention",
+        **kwargs,
+    ):
+        """Dot product attention over blocks of keys with an online softmax
+
+        The keys and values are visited `block_size` at a time, keeping a running max and normalizer for each query,
+        so the full `[B, H, T, T]` attention matrix is never materialized and memory grows with `T * block_size`
+        instead of `T^2`.  Dropout is applied to each block's unnormalized weights, which is the same as applying it
+        to the softmax output.  Since the weights are never formed, `attn` is left as `None`
+
+        If `causal` is set, each query only attends to keys at or before its own position, as if a `subsequent_mask`
+        were applied.  A block of keys starting at `start` is then only scored against the queries from `start` on,
+        so the tiles above the diagonal are never computed, which is about half the work of the full matrix.  This
+        requires self-attention, where the queries and keys line up, and any `mask` passed in must only mask keys
+        (e.g. `[B, 1, 1, T]`), a per-query mask is a `ValueError`
+
+        :param pdrop: (``float``) The dropout probability on the attention weights
+        :param block_size: (``int``) The number of keys to attend to at a time
+        :param scale: (``bool``) Scale the scores by `1/sqrt(d_k)`
+        :param causal: (``bool``) Only attend to keys at or before each query, skipping the tiles above the diagonal
+        :param name: (``str``) The name of the layer
+        """
+        super().__init__(pdrop=pdrop, name=name, **kwargs)
+        self.block_size = block_size
+        self.scale = scale
+        self.causal = causal
+
+    def call(self, qkvm):
+        query, key, value, mask = qkvm
+        training = TRAIN_FLAG()
+        dtype = query.dtype
+        if self.scale:
+            d_k = get_shape_as_list(query)[-1]
+            query *= 1.0 / math.sqrt(d_k) if isinstance(d_k, int) else tf.math.rsqrt(tf.cast(d_k, query.dtype))
+        # Keep the running statistics in float32 so they are safe under mixed precision
+        query, key, value = [tf.cast(t, tf.float32) for t in (query, key, value)]
+        if self.causal:
+            return tf.cast(self._causal_attention(query, key, value, mask, training), dtype)
+        num_keys = tf.shape(key)[2]
+        row_max, row_sum, output = self._init_stats(query, value)
+
+        def body(start, row_max, row_sum, output):
+            end = start + self.block_size
+            block_mask = None if mask is None else mask[..., start:end] == 0
+            stats = self._accumulate_block(
+                query, key[:, :, start:end], value[:, :, start:end], block_mask, row_max, row_sum, output, training
+            )
+            return (end,) + stats
+
+        _, _, row_sum, output = tf.while_loop(
+            lambda start, *_: start < num_keys, body, [tf.constant(0), row_max, row_sum, output]
+        )
+        return tf.cast(output / row_sum, dtype)
+
+    def _causal_attention(self, query, key, value, mask, training):
+        """Attend over lower-triangular tiles only, one block of queries at a time
+
+        The sequence is padded out to a multiple of `block_size` so every tile has the same static shape.  Padded
+        keys are only ever visible to padded queries, which are dropped at the end
+        """
+        if mask is not None and mask.shape[2] != 1:
+            raise ValueError("causal blockwise attention only takes a mask over keys (e.g. `[B, 1, 1, T]`)")
+        num_keys = tf.shape(key)[2]
+        num_blocks = (num_keys + self.block_size - 1) // self.block_size
+        padding = num_blocks * self.block_size - num_keys
+
+        def to_blocks(x):
+            x = tf.pad(x, [[0, 0], [0, 0], [0, padding], [0, 0]])
+            shape = tf.shape(x)
+            return tf.reshape(x, tf.concat([shape[:2], [num_blocks, self.block_size], shape[3:]], axis=0))
+
+        query, key, value = [to_blocks(t) for t in (query, key, value)]
         if mask is not None:
-            scores = masked_fill(scores, mask == 0, -1e9)
+            # The mask only covers keys, `[B, 1, 1, T]` -> `[B, 1, num_blocks, block_size, 1]`
+            mask = to_blocks(tf.expand_dims(mask[:, :, 0], -1))
+        # Only the tiles on the diagonal need a time mask, the ones below it are fully visible
+        future = tf.range(self.block_size)[:, None] < tf.range(self.block_size)[None, :]
+
+        def query_block(i, outputs):
+            q = tf.gather(query, i, axis=2)
+            row_max, row_sum, output = self._init_stats(q, value[:, :, 0])
+
+            def key_block(j, row_max, row_sum, output):
+                block_mask = tf.logical_and(future, tf.equal(i, j))
+                if mask is not None:
+                    block_mask = tf.logical_or(block_mask, tf.transpose(tf.gather(mask, j, axis=2), [0, 1, 3, 2]) == 0)
+                k, v = tf.gather(key, j, axis=2), tf.gather(value, j, axis=2)
+                return (j + 1,) + self._accumulate_block(q, k, v, block_mask, row_max, row_sum, output, training)
+
+            _, _, row_sum, output = tf.while_loop(
+                lambda j, *_: j <= i, key_block, [tf.constant(0), row_max, row_sum, output]
+            )
+            return i + 1, outputs.write(i, output / row_sum)
 
-        return tf.nn.softmax(scores, name="attention_weights")
+        _, outputs = tf.while_loop(
+            lambda i, _: i < num_blocks,
+            query_block,
+            [tf.constant(0), tf.TensorArray(tf.float32, size=num_blocks)],
+        )
+        # [num_blocks, B, H, block_size, D] -> [B, H, num_blocks * block_size, D]
+        output = tf.transpose(outputs.stack(), [1, 2, 0, 3, 4])
+        shape = tf.shape(output)
+        output = tf.reshape(output, tf.concat([shape[:2], [-1], shape[4:]], axis=0))
+        return output[:, :, :num_keys]
+
+    @staticmethod
+    def _init_stats(query, value):
+        stats_shape = tf.concat([tf.shape(query)[:-1], [1]], axis=0)
+        row_max = tf.fill(stats_shape, tf.constant(-np.inf, tf.float32))
+        row_sum = tf.zeros(stats_shape)
+        output = tf.zeros(tf.concat([tf.shape(query)[:-1], tf.shape(value)[-1:]], axis=0))
+        return row_max, row_sum, output
+
+    def _accumulate_block(self, query, key, value, block_mask, row_max, row_sum, output, training):
+        """Fold one block of keys and values into the running max, normalizer and (unnormalized) output"""
+        scores = tf.matmul(query, key, transpose_b=True)
+        if block_mask is not None:
+            scores = masked_fill(scores, block_mask, -1e9)
+        new_max = tf.maximum(row_max, tf.reduce_max(scores, axis=-1, keepdims=True))
+        weights = tf.exp(scores - new_max)
+        correction = tf.exp(row_max - new_max)
+        row_sum = correction * row_sum + tf.reduce_sum(weights, axis=-1, keepdims=True)
+        weights = self.dropout(weights, training=training)
+        output = correction * output + tf.matmul(weights, value)
+        return new_max, row_sum, output
+
+
+def _build_layer(layer: tf.keras.layers.Layer, input_shape):
+    """Build a layer that is used through its weights rather than called, keeping its usual variable names"""
+    if not layer.built:
+        with tf.name_scope(layer.name):
+            layer.build(input_shape)
+
+
+class _FusedProjections:
+    """Several `Dense` projections of the same input, with their kernels and biases concatenated for one GEMM
+
+    Inside a traced function the concatenated weights are kept along with the graph they belong to, so a layer that is
+    applied more than once in a trace (e.g. a shared layer, or a decoder step unrolled by hand) only concatenates its
+    kernels once.  A new trace (or eager execution, where there is no graph to reuse them in) concatenates them again.
+    The `Dense` layers keep their own variables, so checkpoints and `serialize` see the same weights either way
+    """
+
+    def __init__(self, projections: List[tf.keras.layers.Dense]):
+        self.projections = projections
+        self._graph = None
+        self._weights = None
+
+    def __len__(self):
+        return len(self.projections)
+
+    def weights(self, x):
+        """Get the concatenated `[d_model, n * H * D]` kernel and `[n * H * D]` bias, cast to the dtype of `x`"""
+        for w in self.projections:
+            _build_layer(w, x.shape)
+        graph = None if tf.executing_eagerly() else tf.compat.v1.get_default_graph()
+        if graph is None or graph is not self._graph or self._weights[0].dtype != x.dtype:
+            kernel = tf.cast(tf.concat([w.kernel for w in self.projections], axis=-1), x.dtype)
+            bias = tf.cast(tf.concat([w.bias for w in self.projections], axis=-1), x.dtype)
+            self._graph, self._weights = graph, (kernel, bias)
+        return self._weights
+
+
+def split_heads_projection(
+    x, projections: Union[List[tf.keras.layers.Dense], _FusedProjections], num_heads: int, d_k: int
+) -> List:
+    """Apply one or more `Dense` projections to `x` and split each into heads, all in a single einsum
+
+    The kernels are viewed as `[d_model, H, D]`, so the GEMM writes the `[B, H, T, D]` layout directly instead of
+    reshaping and transposing its output.  Passing several projections of the same input (the self-attention Q, K and
+    V) concatenates their kernels so they share one GEMM.  A layer that does this on every call should hold on to a
+    `_FusedProjections`, which only concatenates them once per trace
+
+    :param x: The `[B, T, d_model]` input
+    :param projections: The `Dense` layers to apply
+    :param num_heads: The number of heads `H`
+    :param d_k: The size of each head `D`
+    :return: A list with a `[B, H, T, D]` tensor for each projection
+    """
+    if not isinstance(projections, _FusedProjections):
+        projections = _FusedProjections(projections)
+    n = len(projections)
+    kernel, bias = projections.weights(x)
+    kernel = tf.reshape(kernel, [-1, n, num_heads, d_k])
+    bias = tf.reshape(bias, [n, 1, num_heads, 1, d_k])
+    heads = tf.einsum("btd,dnhk->nbhtk", x, kernel) + bias
+    return tf.unstack(heads, num=n)
+
+
+def merge_heads_projection(x, projection: tf.keras.layers.Dense):
+    """Merge the heads of `x` and apply the output projection in a single einsum
+
+    :param x: The `[B, H, T, D]` attention output
+    :param projection: The `Dense` output projection, taking `H * D` inputs
+    :return: The `[B, T, d_out]` output
+    """
+    num_heads, d_k = get_shape_as_list(x)[1], get_shape_as_list(x)[-1]
+    _build_layer(projection, tf.TensorShape([None, None, num_heads * d_k]))
+    kernel = tf.reshape(tf.cast(projection.kernel, x.dtype), [num_heads, d_k, -1])
+    return tf.einsum("bhtk,hkd->btd", x, kernel) + tf.cast(projection.bias, x.dtype)
 
 
 class MultiHeadedAttention(tf.keras.layers.Layer):
@@ -1788,6 +2171,8 @@ class MultiHeadedAttention(tf.keras.layers.Layer):
         scale: bool = False,
         d_k: Optional[int] = None,
         name: str = None,
+        block_size: Optional[int] = None,
+        causal: bool = False,
     ):
         """Constructor for multi-headed attention
 
@@ -1795,6 +2180,9 @@ class MultiHeadedAttention(tf.keras.layers.Layer):
         :param d_model: The model hidden size
         :param dropout (``float``): The amount of dropout to use
         :param attn_fn: A function to apply attention, defaults to SDP
+        :param block_size: (``int``) If given, attend over this many keys at a time with an online softmax instead of
+            materializing the full attention matrix (see `SeqBlockwiseDotProductAttention`)
+        :param causal: (``bool``) Apply a subsequent mask implicitly, skipping the masked blocks.  Requires `block_size`
         """
         super().__init__(name=name)
 
@@ -1810,7 +2198,13 @@ class MultiHeadedAttention(tf.keras.layers.Layer):
         self.w_K = tf.keras.layers.Dense(units=self.d_k * self.h, name="key_projection")
         self.w_V = tf.keras.layers.Dense(units=self.d_k * self.h, name="value_projection")
         self.w_O = tf.keras.layers.Dense(units=self.d_k * self.h, name="output_projection")
-        if scale:
+        self.w_QKV = _FusedProjections([self.w_Q, self.w_K, self.w_V])
+        self.w_KV = _FusedProjections([self.w_K, self.w_V])
+        if causal and block_size is None:
+            raise ValueError("causal attention is only supported with a block_size")
+        if block_size is not None:
+            self.attn_fn = SeqBlockwiseDotProductAttention(dropout, block_size=block_size, scale=scale, causal=causal)
+        elif scale:
             self.attn_fn = SeqScaledDotProductAttention(dropout)
         else:
             self.attn_fn = SeqDotProductAttention(dropout)
@@ -1818,19 +2212,64 @@ class MultiHeadedAttention(tf.keras.layers.Layer):
 
     def call(self, qkvm):
         query, key, value, mask = qkvm
-        batchsz = get_shape_as_list(query)[0]
 
-        # (B, T, H, D) -> (B, H, T, D)
-        query = tf.transpose(tf.reshape(self.w_Q(query), [batchsz, -1, self.h, self.d_k]), [0, 2, 1, 3])
-        key = tf.transpose(tf.reshape(self.w_K(key), [batchsz, -1, self.h, self.d_k]), [0, 2, 1, 3])
-        value = tf.transpose(tf.reshape(self.w_V(value), [batchsz, -1, self.h, self.d_k]), [0, 2, 1, 3])
+        # (B, T, H*D) -> (B, H, T, D)
+        if query is key and key is value:
+            # Self-attention projects one input three ways, so do all three in one GEMM
+            query, key, value = split_heads_projection(query, self.w_QKV, self.h, self.d_k)
+        else:
+            (query,) = split_heads_projection(query, [self.w_Q], self.h, self.d_k)
+            key, value = self.project_key_value(key, value)
+        return self._attend(query, key, value, mask)
+
+    def project_key_value(self, key, value):
+        """Project the keys and values into heads
+
+        For encoder-decoder attention these only depend on the encoder output, so a decoder can project them once and
+        reuse them at every step with `call_with_projected_kv`
+
+        :param key: The `[B, S, d_model]` keys
+        :param value: The `[B, S, d_model]` values
+        :return: The key and value heads, each `[B, H, S, D]`
+        """
+        if key is value:
+            return split_heads_projection(key, self.w_KV, self.h, self.d_k)
+        (key,) = split_heads_projection(key, [self.w_K], self.h, self.d_k)
+        (value,) = split_heads_projection(value, [self.w_V], self.h, self.d_k)
+        return key, value
+
+    def call_with_projected_kv(self, qkvm):
+        """Attend with keys and values that already came from `project_key_value`
+
+        :param qkvm: `(query, key, value, mask)`, where only the query still needs to be projected
+        :return: The `[B, T, d_model]` output
+        """
+        query, key, value, mask = qkvm
+        (query,) = split_heads_projection(query, [self.w_Q], self.h, self.d_k)
+        return self._attend(query, key, value, mask)
+
+    def _attend(self, query, key, value, mask):
         x = self.attn_fn((query, key, value, mask))
         self.attn = self.attn_fn.attn
 
-        # (B, H, T, D) -> (B, T, H, D) -> (B, T, H*D)
-        x = tf.transpose(x, [0, 2, 1, 3])
-        x = tf.reshape(x, [batchsz, -1, self.h * self.d_k])
-        return self.w_O(x)
+        # (B, H, T, D) -> (B, T, H*D)
+        return merge_heads_projection(x, self.w_O)
+
+
+@lru_cache(maxsize=32)
+def relative_position_edges(seq_len: int, rpr_k: int) -> np.ndarray:
+    """Build the `[T, T]` matrix of relative distances, shifted by `rpr_k` and clipped to `[0, 2 * rpr_k]`
+
+    This only depends on the length and the window, so it is cached and shared by every layer in a stack
+
+    :param seq_len: The sequence length `T`
+    :param rpr_k: The relative attention window size
+    :return: A read-only `[T, T]` `int32` array of embedding indices
+    """
+    seq = np.arange(seq_len, dtype=np.int32)
+    edges = np.clip(seq[np.newaxis, :] - seq[:, np.newaxis] + rpr_k, 0, 2 * rpr_k)
+    edges.flags.writeable = False
+    return edges
 
 
 class MultiHeadedRelativeAttention(tf.keras.layers.Layer):
@@ -1880,21 +2319,41 @@ class MultiHeadedRelativeAttention(tf.keras.layers.Layer):
         self.w_K = tf.keras.layers.Dense(units=self.d_k * self.h, name="key_projection")
         self.w_V = tf.keras.layers.Dense(units=self.d_k * self.h, name="value_projection")
         self.w_O = tf.keras.layers.Dense(units=self.d_k * self.h, name="output_projection")
+        self.w_QKV = _FusedProjections([self.w_Q, self.w_K, self.w_V])
         if scale:
             self.attn_fn = SeqScaledDotProductRelativeAttention(dropout)
         else:
             self.attn_fn = SeqDotProductRelativeAttention(dropout)
         self.attn = None
 
-    def make_rpr(self, seq_len: int):
+    def make_rpr_edges(self, seq_len: int):
         """Create a matrix shifted by self.rpr_k and bounded between 0 and 2*self.rpr_k to provide 0-based indexing for embedding
         """
+        if isinstance(seq_len, int):
+            # A static length gets the shared, precomputed edges as a constant
+            return tf.constant(relative_position_edges(seq_len, self.rpr_k))
         seq = tf.range(seq_len)
         window_len = 2 * self.rpr_k
         edges = tf.reshape(seq, [1, -1]) - tf.reshape(seq, [-1, 1]) + self.rpr_k
-        edges = tf.clip_by_value(edges, 0, window_len)
+        return tf.clip_by_value(edges, 0, window_len)
+
+    def make_rpr(self, seq_len: int):
+        """Look up the `[T, T, D]` key and value relative position representations"""
+        edges = self.make_rpr_edges(seq_len)
         return self.rpr_key(edges), self.rpr_value(edges)
 
+    def make_rpr_tables(self, seq_len: int):
+        """Get the key and value relative position representations as `(table, one_hot_edges)` pairs
+
+        The attention picks out the table rows with the `[T, T, R]` one-hot edges inside its einsums, which
+        never materializes the `[T, T, D]` lookups from `make_rpr`.  Only the `int32` edges are embedded in the graph,
+        the one-hot is built from them at run time so each layer doesn't carry its own `[T, T, R]` constant
+        """
+        one_hot = tf.one_hot(self.make_rpr_edges(seq_len), 2 * self.rpr_k + 1)
+        _build_layer(self.rpr_key, tf.TensorShape([None, None]))
+        _build_layer(self.rpr_value, tf.TensorShape([None, None]))
+        return (self.rpr_key.embeddings, one_hot), (self.rpr_value.embeddings, one_hot)
+
     def call(self, qkvm):
         """Low-order projections of query, key and value into multiple heads, then attention application and dropout
 
@@ -1905,22 +2364,39 @@ class MultiHeadedRelativeAttention(tf.keras.layers.Layer):
         :return: Multi-head attention output, result of attention application to sequence (B, T, d_model)
         """
         query, key, value, mask = qkvm
-        shp = get_shape_as_list(query)
-        batchsz = shp[0]
-        seq_len = shp[1]
+        seq_len = get_shape_as_list(query)[1]
 
-        # (B, T, H, D) -> (B, H, T, D)
-        query = tf.transpose(tf.reshape(self.w_Q(query), [batchsz, -1, self.h, self.d_k]), [0, 2, 1, 3])
-        key = tf.transpose(tf.reshape(self.w_K(key), [batchsz, -1, self.h, self.d_k]), [0, 2, 1, 3])
-        value = tf.transpose(tf.reshape(self.w_V(value), [batchsz, -1, self.h, self.d_k]), [0, 2, 1, 3])
+        # (B, T, H*D) -> (B, H, T, D)
+        if query is key and key is value:
+            query, key, value = split_heads_projection(query, self.w_QKV, self.h, self.d_k)
+        else:
+            (query,) = split_heads_projection(query, [self.w_Q], self.h, self.d_k)
+            (key,) = split_heads_projection(key, [self.w_K], self.h, self.d_k)
+            (value,) = split_heads_projection(value, [self.w_V], self.h, self.d_k)
 
-        rpr_key, rpr_value = self.make_rpr(seq_len)
+        rpr_key, rpr_value = self.make_rpr_tables(seq_len)
         x = self.attn_fn((query, key, value, rpr_key, rpr_value, mask))
         self.attn = self.attn_fn.attn
-        # (B, H, T, D) -> (B, T, H, D) -> (B, T, H*D)
-        x = tf.transpose(x, [0, 2, 1, 3])
-        x = tf.reshape(x, [batchsz, -1, self.h * self.d_k])
-        return self.w_O(x)
+        # (B, H, T, D) -> (B, T, H*D)
+        return merge_heads_projection(x, self.w_O)
+
+
+class LayerNormalization(tf.keras.layers.LayerNormalization):
+    """A Keras `LayerNormalization` that XLA compiles into one fused kernel when `set_tf_jit_compile` is on
+
+    It shares the Keras layer's class name, so it gets the same auto-generated `layer_normalization*` names (and
+    variables) and checkpoints restore into either one.  Without XLA it is just the Keras layer
+    """
+
+    def __init__(self, *args, jit_compile: Optional[bool] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        jit_compile = TF_JIT_COMPILE if jit_compile is None else jit_compile
+        self._fused_call = tf_function(jit_compile=True)(super().call) if jit_compile else None
+
+    def call(self, inputs):
+        if self._fused_call is None:
+            return super().call(inputs)
+        return self._fused_call(inputs)
 
 
 class TransformerEncoder(tf.keras.layers.Layer):
@@ -1936,6 +2412,8 @@ class TransformerEncoder(tf.keras.layers.Layer):
         rpr_k: Optional[int] = None,
         ffn_pdrop: Optional[float] = 0.0,
         name: Optional[str] = None,
+        block_size: Optional[int] = None,
+        causal: bool = False,
     ):
         super().__init__(name=name)
         self.d_model = d_model
@@ -1943,11 +2421,13 @@ class TransformerEncoder(tf.keras.layers.Layer):
         if rpr_k is not None:
             self.self_attn = MultiHeadedRelativeAttention(num_heads, d_model, rpr_k, pdrop, scale, d_k=d_k)
         else:
-            self.self_attn = MultiHeadedAttention(num_heads, d_model, pdrop, scale=scale, d_k=d_k)
+            self.self_attn = MultiHeadedAttention(
+                num_heads, d_model, pdrop, scale=scale, d_k=d_k, block_size=block_size, causal=causal
+            )
 
-        self.ffn = FFN(d_model, activation_type, d_ff, pdrop=ffn_pdrop, name="ffn")
-        self.ln1 = tf.keras.layers.LayerNormalization(epsilon=1e-6)
-        self.ln2 = tf.keras.layers.LayerNormalization(epsilon=1e-6)
+        self.ffn = FFN(d_model, ffn_pdrop, activation_type, d_ff, name="ffn")
+        self.ln1 = LayerNormalization(epsilon=1e-6)
+        self.ln2 = LayerNormalization(epsilon=1e-6)
         self.dropout = tf.keras.layers.Dropout(pdrop)
 
     def call(self, inputs):
@@ -1956,13 +2436,14 @@ class TransformerEncoder(tf.keras.layers.Layer):
         :return: The output tensor
         """
         x, mask = inputs
+        training = TRAIN_FLAG()
 
         x = self.ln1(x)
         h = self.self_attn((x, x, x, mask))
-        x = x + self.dropout(h, TRAIN_FLAG())
+        x = x + self.dropout(h, training)
 
         x = self.ln2(x)
-        x = x + self.dropout(self.ffn(x), TRAIN_FLAG())
+        x = x + self.dropout(self.ffn(x), training)
         return x
 
 
@@ -1984,21 +2465,35 @@ class TransformerDecoder(tf.keras.layers.Layer):
         self.self_attn = MultiHeadedAttention(num_heads, self.d_model, pdrop, scale=scale, name="self_attention")
         self.src_attn = MultiHeadedAttention(num_heads, self.d_model, pdrop, scale=scale, name="src_attention")
         self.ffn = FFN(d_model, ffn_pdrop, activation_type, d_ff, name="ffn")
-        self.ln1 = tf.keras.layers.LayerNormalization(epsilon=1e-6)
-        self.ln2 = tf.keras.layers.LayerNormalization(epsilon=1e-6)
-        self.ln3 = tf.keras.layers.LayerNormalization(epsilon=1e-6)
+        self.ln1 = LayerNormalization(epsilon=1e-6)
+        self.ln2 = LayerNormalization(epsilon=1e-6)
+        self.ln3 = LayerNormalization(epsilon=1e-6)
         self.dropout = tf.keras.layers.Dropout(pdrop)
 
-    def call(self, inputs):
+    def call(self, inputs, cache: Optional[Dict] = None):
+        """
+        :param inputs: `(x, memory, src_mask, tgt_mask)`
+        :param cache: An optional dict that keeps the projected `memory` keys and values between decoding steps.  Pass
+            the same (initially empty) dict for each step over the same `memory`
+        :return: The output tensor
+        """
         x, memory, src_mask, tgt_mask = inputs
+        training = TRAIN_FLAG()
         x = self.ln1(x)
-        x = x + self.dropout(self.self_attn((x, x, x, tgt_mask)), TRAIN_FLAG())
+        x = x + self.dropout(self.self_attn((x, x, x, tgt_mask)), training)
 
         x = self.ln2(x)
-        x = x + self.dropout(self.src_attn((x, memory, memory, src_mask)), TRAIN_FLAG())
+        if cache is None:
+            h = self.src_attn((x, memory, memory, src_mask))
+        else:
+            if "src_kv" not in cache:
+                cache["src_kv"] = self.src_attn.project_key_value(memory, memory)
+            src_k, src_v = cache["src_kv"]
+            h = self.src_attn.call_with_projected_kv((x, src_k, src_v, src_mask))
+        x = x + self.dropout(h, training)
 
         x = self.ln3(x)
-        x = x + self.dropout(self.ffn(x), TRAIN_FLAG())
+        x = x + self.dropout(self.ffn(x), training)
         return x
 
 
@@ -2016,12 +2511,17 @@ class TransformerEncoderStack(tf.keras.layers.Layer):
         rpr_k: Optional[Union[int, List[int]]] = None,
         ffn_pdrop: Optional[float] = 0.0,
         name=None,
+        block_size: Optional[int] = None,
+        causal: bool = False,
+        jit_compile: Optional[bool] = None,
         **kwargs,
     ):
 
         super().__init__(name=name)
         self.encoders = []
-        self.ln = tf.keras.layers.LayerNormalization(epsilon=1e-6)
+        self.ln = LayerNormalization(epsilon=1e-6)
+        # XLA recompiles for every new sequence length, so it is opt-in (`None` follows `set_tf_jit_compile`)
+        self._call = tf_function(jit_compile=jit_compile)(self._call)
 
         if not is_sequence(rpr_k):
             rpr_k = [rpr_k] * layers
@@ -2039,11 +2539,19 @@ class TransformerEncoderStack(tf.keras.layers.Layer):
                     rpr_k=rpr_k[i],
                     ffn_pdrop=ffn_pdrop,
                     name=name,
+                    block_size=block_size,
+                    causal=causal,
                 )
             )
 
     def call(self, inputs):
         x, mask = inputs
+        return self._call(x, mask, TRAIN_FLAG())
+
+    def _call(self, x, mask, training):
+        # The whole stack is traced once per train flag.  Under XLA it can fuse across the layer boundaries and plan
+        # the buffers for the whole stack up front, reusing the per-layer Q/K/V and attention outputs in place of
+        # allocating fresh ones for each layer
         for layer in self.encoders:
             x = layer((x, mask))
         return self.ln(x)
@@ -2064,7 +2572,19 @@ class TransformerEncoderStackWithLengths(TransformerEncoderStack):
         name: Optional[str] = None,
         **kwargs,
     ):
-        super().__init__(num_heads, d_model, pdrop, scale, layers, activation, d_ff, d_k, rpr_k, name=name)
+        super().__init__(
+            num_heads,
+            d_model,
+            pdrop,
+            scale,
+            layers,
+            activation,
+            d_ff,
+            d_k,
+            rpr_k,
+            name=name,
+            jit_compile=kwargs.get("jit_compile"),
+        )
         self.proj = WithDropout(tf.keras.layers.Dense(d_model), pdrop)
 
     def call(self, inputs):
@@ -2090,12 +2610,32 @@ class TransformerEncoderStackWithTimeMask(TransformerEncoderStack):
         name: Optional[str] = None,
         **kwargs,
     ):
-        super().__init__(num_heads, d_model, pdrop, scale, layers, activation, d_ff, d_k, rpr_k, name=name)
+        # With a `block_size` the time mask is applied inside the attention, which skips the future blocks entirely
+        block_size = kwargs.get("block_size")
+        causal = block_size is not None and rpr_k is None
+        super().__init__(
+            num_heads,
+            d_model,
+            pdrop,
+            scale,
+            layers,
+            activation,
+            d_ff,
+            d_k,
+            rpr_k,
+            name=name,
+            block_size=block_size,
+            causal=causal,
+            jit_compile=kwargs.get("jit_compile"),
+        )
+        self.causal = causal
         self.proj = WithDropout(tf.keras.layers.Dense(d_model), pdrop)
 
     def call(self, inputs):
         x, _ = inputs
         x = self.proj(x)
+        if self.causal:
+            return super().call((x, None))
         max_seqlen = get_shape_as_list(x)[1]
         mask = subsequent_mask(max_seqlen)
         return super().call((x, mask))
@@ -2117,16 +2657,21 @@ class TransformerDecoderStack(tf.keras.layers.Layer):
     ):
         super().__init__(name=name)
         self.decoders = []
-        self.ln = tf.keras.layers.LayerNormalization(epsilon=1e-6)
+        self.ln = LayerNormalization(epsilon=1e-6)
         for i in range(layers):
             self.decoders.append(
                 TransformerDecoder(d_model, num_heads, pdrop, scale, activation, d_ff, ffn_pdrop=ffn_pdrop)
             )
 
-    def call(self, inputs):
+    def call(self, inputs, cache: Optional[Dict] = None):
+        """
+        :param inputs: `(x, memory, src_mask, tgt_mask)`
+        :param cache: An optional dict to reuse each layer's projected `memory` between decoding steps
+        :return: The output tensor
+        """
         x, memory, src_mask, tgt_mask = inputs
-        for layer in self.decoders:
-            x = layer((x, memory, src_mask, tgt_mask))
+        for i, layer in enumerate(self.decoders):
+            x = layer((x, memory, src_mask, tgt_mask), cache=None if cache is None else cache.setdefault(i, {}))
         return self.ln(x)
 
 
@@ -2144,45 +2689,88 @@ class FFN(tf.keras.layers.Layer):
         activation: str = "relu",
         d_ff: Optional[int] = None,
         name: Optional[int] = None,
+        gated: bool = False,
     ):
         """Constructor, takes in model size (which is the external currency of each block) and the feed-forward size
 
         :param d_model: The model size.  This is the size passed through each block
         :param d_ff: The feed-forward internal size, which is typical 4x larger, used internally
         :param pdrop: The probability of dropping output
+        :param gated: Gate the activated expansion with a second linear expansion (GLU, or SwiGLU with `swish`)
         """
         super().__init__(name=name)
         if d_ff is None:
             d_ff = 4 * d_model
         self.expansion = tf.keras.layers.Dense(d_ff)
+        self.expansion_v = tf.keras.layers.Dense(d_ff) if gated else None
         self.squeeze = tf.keras.layers.Dense(d_model)
         self.dropout = tf.keras.layers.Dropout(pdrop)
         self.act = tf.keras.layers.Activation(activation)
+        self._call = tf_function(jit_compile=None)(self._call)
 
     def call(self, inputs):
-        return self.squeeze(self.dropout(self.act(self.expansion(inputs))))
+        return self._call(inputs, TRAIN_FLAG())
+
+    def _call(self, inputs, training):
+        # Compiled, XLA can apply the bias and activation (and the gate) in the expansion GEMM's epilogue
+        x = self.act(self.expansion(inputs))
+        if self.expansion_v is not None:
+            x = x * self.expansion_v(inputs)
+        return self.squeeze(self.dropout(x, training))
+
+
+# The score for disallowed transitions.  It is finite so a fully masked row still normalizes without NaNs
+_CRF_MASK_VALUE = -1e4
+
+
+def go_start_scores(num_tags: int, log_probs: bool = False) -> np.ndarray:
+    """Build the `[1, 1, N]` scores for the `<GO>` step that the decoders prepend to the unary scores
+
+    :param num_tags: The number of tags `N`
+    :param log_probs: Normalize the scores with a log softmax
+    :return: A `float32` array that is `0` at `Offsets.GO` and `_CRF_MASK_VALUE` elsewhere (before any normalization)
+    """
+    gos = np.full((1, 1, num_tags), _CRF_MASK_VALUE, dtype=np.float32)
+    gos[:, :, Offsets.GO] = 0
+    if log_probs:
+        top = gos.max(-1, keepdims=True)
+        gos -= top + np.log(np.sum(np.exp(gos - top), -1, keepdims=True))
+    return gos
 
 
 class TaggerGreedyDecoder(tf.keras.layers.Layer):
     def __init__(self, num_tags: int, constraint_mask: Optional[Tuple[Any, Any]] = None, name: Optional[str] = None):
-        super().__init__(name=name)
+        # The decoder stays in float32 even under a mixed precision policy
+        super().__init__(name=name, dtype=tf.float32)
         self.num_tags = num_tags
         self.inv_mask = None
         if constraint_mask is not None:
             _, inv_mask = constraint_mask
-            self.inv_mask = inv_mask * tf.constant(-1e4)
+            self.inv_mask = tf.convert_to_tensor(inv_mask, dtype=tf.float32) * _CRF_MASK_VALUE
 
             self.A = self.add_weight(
-                "transitions_raw", shape=(num_tags, num_tags), dtype=tf.float32, init="zeros", trainable=False
+                "transitions_raw", shape=(num_tags, num_tags), dtype=tf.float32, initializer="zeros", trainable=False
             )
+            self._go_start = go_start_scores(num_tags)
+        self._inference_transitions = None
 
     @property
     def transitions(self):
+        if self._inference_transitions is not None:
+            return self._inference_transitions
         if self.inv_mask is not None:
             return tf.nn.log_softmax(self.A + self.inv_mask)
         return self.A
 
+    def finalize_for_inference(self):
+        """Freeze the (normalized) transitions to a constant so decoding doesn't rebuild them on every call
+
+        Call this once the weights are loaded.  Later changes to the weights are not picked up
+        """
+        self._inference_transitions = tf.constant(tf.keras.backend.get_value(self.transitions))
+
     def neg_log_loss(self, unary, tags, lengths):
+        unary = tf.cast(unary, tf.float32)
         mask = tf.sequence_mask(lengths, tf.shape(unary)[1])
         cross_entropy = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=tags, logits=unary)
         cross_entropy *= tf.cast(mask, tf.float32)
@@ -2192,14 +2780,11 @@ class TaggerGreedyDecoder(tf.keras.layers.Layer):
     def call(self, inputs, training=False, mask=None):
 
         unary, lengths = inputs
+        unary = tf.cast(unary, tf.float32)
 
         if self.inv_mask is not None:
             bsz = tf.shape(unary)[0]
-            lsz = self.num_tags
-            np_gos = np.full((1, 1, lsz), -1e4, dtype=np.float32)
-            np_gos[:, :, Offsets.GO] = 0
-            gos = tf.constant(np_gos)
-            start = tf.tile(gos, [bsz, 1, 1])
+            start = tf.broadcast_to(self._go_start, [bsz, 1, self.num_tags])
             probv = tf.concat([start, unary], axis=1)
             viterbi, path_scores = crf_decode(probv, self.transitions, lengths + 1)
             return tf.identity(viterbi[:, 1:], name="best"), path_scores
@@ -2214,7 +2799,8 @@ class CRF(tf.keras.layers.Layer):
         :param constraint_mask: torch.ByteTensor, Constraints on the transitions [1, N, N]
         :param name: str, Optional name, defaults to `None`
         """
-        super().__init__(name=name)
+        # The forward algorithm and Viterbi sum over many steps, so keep them in float32 under mixed precision
+        super().__init__(name=name, dtype=tf.float32)
 
         self.A = self.add_weight("transitions_raw", shape=(num_tags, num_tags), dtype=tf.float32)
         self.num_tags = num_tags
@@ -2222,14 +2808,27 @@ class CRF(tf.keras.layers.Layer):
         self.inv_mask = None
         if constraint_mask is not None:
             self.mask, inv_mask = constraint_mask
-            self.inv_mask = inv_mask * tf.constant(-1e4)
+            self.inv_mask = tf.convert_to_tensor(inv_mask, dtype=tf.float32) * _CRF_MASK_VALUE
+        # The <GO> step is the same for every batch, so only build it once
+        self._go_start = go_start_scores(num_tags, log_probs=True)
+        self._inference_transitions = None
 
     @property
     def transitions(self):
+        if self._inference_transitions is not None:
+            return self._inference_transitions
         if self.inv_mask is not None:
             return (self.A * self.mask) + self.inv_mask
         return self.A
 
+    def finalize_for_inference(self):
+        """Freeze the (masked) transitions to a constant so decoding doesn't rebuild them on every call
+
+        Call this once training is done or the weights are loaded.  The frozen transitions don't get gradients and
+        later changes to the weights are not picked up
+        """
+        self._inference_transitions = tf.constant(tf.keras.backend.get_value(self.transitions))
+
     def score_sentence(self, unary, tags, lengths):
         """Score a batch of sentences.
 
@@ -2239,13 +2838,14 @@ class CRF(tf.keras.layers.Layer):
 
         :return: torch.FloatTensor: [B]
         """
+        unary = tf.cast(unary, tf.float32)
         return crf_sequence_score(unary, tf.cast(tags, tf.int32), tf.cast(lengths, tf.int32), self.transitions)
 
     def call(self, inputs, training=False):
 
         unary, lengths = inputs
         if training:
-            return crf_log_norm(unary, lengths, self.transitions)
+            return crf_log_norm(tf.cast(unary, tf.float32), lengths, self.transitions)
         else:
             return self.decode(unary, lengths)
 
@@ -2258,15 +2858,9 @@ class CRF(tf.keras.layers.Layer):
         :return: List[torch.LongTensor]: [B] the paths
         :return: torch.FloatTensor: [B] the path score
         """
+        unary = tf.cast(unary, tf.float32)
         bsz = tf.shape(unary)[0]
-        lsz = self.num_tags
-        np_gos = np.full((1, 1, lsz), -1e4, dtype=np.float32)
-        np_gos[:, :, Offsets.GO] = 0
-        gos = tf.constant(np_gos)
-
-        start = tf.tile(gos, [bsz, 1, 1])
-        start = tf.nn.log_softmax(start, axis=-1)
-
+        start = tf.broadcast_to(self._go_start, [bsz, 1, self.num_tags])
         probv = tf.concat([start, unary], axis=1)
 
         viterbi, path_scores = crf_decode(probv, self.transitions, lengths + 1)
@@ -2281,8 +2875,12 @@ class CRF(tf.keras.layers.Layer):
 
         :return: torch.FloatTensor: [B]
         """
-        fwd_score = self((unary, tf.cast(lengths, tf.int32)), training=True)
-        gold_score = self.score_sentence(unary, tags, lengths)
+        # With a constraint mask the transitions are rebuilt on every access, so share one copy between the scores
+        transitions = self.transitions
+        unary = tf.cast(unary, tf.float32)
+        lengths = tf.cast(lengths, tf.int32)
+        fwd_score = crf_log_norm(unary, lengths, transitions)
+        gold_score = crf_sequence_score(unary, tf.cast(tags, tf.int32), lengths, transitions)
         log_likelihood = gold_score - fwd_score
         return -tf.reduce_mean(log_likelihood)
 
@@ -2314,13 +2912,18 @@ class MeanPool1D(tf.keras.layers.Layer):
         super().__init__(trainable, name, dtype)
         self.output_dim = dsz
         self.reduction_dim = 1 if batch_first else 0
+        self._call = tf_function(jit_compile=None)(self._call)
 
     def call(self, inputs):
         tensor, lengths = tensor_and_lengths(inputs)
+        return self._call(tensor, lengths)
+
+    def _call(self, tensor, lengths):
         # Regardless of whether the input is batch first or time first the result of the
         # sum is `[B, H]` so the lengths (which is `[B]`) should always be expanded with
-        # `-1` to `[B, -1]` so that is broadcasts.
-        return tf.reduce_sum(tensor, self.reduction_dim) / tf.cast(tf.expand_dims(lengths, -1), tf.float32)
+        # `-1` to `[B, -1]` so that is broadcasts.  Empty sequences pool to zeros rather than NaN
+        inv_lengths = tf.math.reciprocal(tf.cast(tf.maximum(lengths, 1), tensor.dtype))
+        return tf.reduce_sum(tensor, self.reduction_dim) * tf.expand_dims(inv_lengths, -1)
 
     @property
     def requires_length(self):
@@ -2575,14 +3178,39 @@ def tf_device_wrapper(func):
     return with_device
 
 
+def keys_mask_bias(keys_mask, dtype):
+    """Turn a mask over the keys into a bias that is added to the scores before the softmax
+
+    Adding the bias folds the masking into the softmax's input, instead of a separate compare and select
+
+    :param keys_mask: A `[B, T]` mask (``bool`` or numeric) where `0` means the key is padding
+    :param dtype: The dtype of the scores
+    :return: A `[B, T]` bias that is `0` for valid keys and a large negative value for masked ones
+    """
+    mask_value = tf.float16.min if dtype == tf.float16 else -1e9
+    return tf.cast((1.0 - tf.cast(keys_mask, tf.float32)) * mask_value, dtype)
+
+
 class VectorSequenceAttention(tf.keras.layers.Layer):
     def __init__(self, hsz):
         super().__init__()
         self.hsz = hsz
         self.W_c = tf.keras.layers.Dense(hsz, use_bias=False)
 
-    def call(self, qkvm):
+    def call(self, qkvm, cache: Optional[Dict] = None):
+        """
+        :param qkvm: `(query_t, keys_bth, values_bth, keys_mask)`
+        :param cache: An optional dict that keeps the projected keys between decoding steps.  Pass the same (initially
+            empty) dict for each step over the same keys
+        :return: The attended output
+        """
         query_t, keys_bth, values_bth, keys_mask = qkvm
+        if cache is None:
+            keys_bth = self.project_keys(keys_bth)
+        else:
+            if "keys" not in cache:
+                cache["keys"] = self.project_keys(keys_bth)
+            keys_bth = cache["keys"]
         # Output(t) = B x H x 1
         # Keys = B x T x H
         # a = B x T x 1
@@ -2591,6 +3219,14 @@ class VectorSequenceAttention(tf.keras.layers.Layer):
 
         return attended
 
+    def project_keys(self, keys_bth):
+        """Do the part of the scoring that only depends on the keys, which is the same for every decoding step
+
+        :param keys_bth: The keys `[B, T, H]`
+        :return: The keys as `_attention` takes them
+        """
+        return keys_bth
+
     def _attention(self, query_t, keys_bth, keys_mask):
         pass
 
@@ -2602,20 +3238,25 @@ class VectorSequenceAttention(tf.keras.layers.Layer):
         a = tf.reshape(a, [B, 1, H])
         c_t = tf.squeeze(a @ values_bth, 1)
 
-        attended = tf.concat([c_t, query_t], -1)
-        attended = tf.nn.tanh(self.W_c(attended))
+        attended = tf.nn.tanh(self._project_context(c_t, query_t))
         return attended
 
+    def _project_context(self, c_t, query_t):
+        """Apply `W_c` to `[c_t; query_t]` as two matmuls against the halves of its kernel, without the concat"""
+        ctx_dim = get_shape_as_list(c_t)[-1]
+        _build_layer(self.W_c, tf.TensorShape([None, ctx_dim + get_shape_as_list(query_t)[-1]]))
+        kernel = self.W_c.kernel
+        return tf.matmul(c_t, kernel[:ctx_dim]) + tf.matmul(query_t, kernel[ctx_dim:])
+
 
 class LuongDotProductAttention(VectorSequenceAttention):
     def __init__(self, hsz: int):
         super().__init__(hsz)
 
     def _attention(self, query_t, keys_bth, keys_mask):
-        a = keys_bth @ tf.expand_dims(query_t, 2)
-        a = tf.squeeze(a, -1)
+        a = tf.linalg.matvec(keys_bth, query_t)
         if keys_mask is not None:
-            masked_fill(a, keys_mask == 0, -1e9)
+            a += keys_mask_bias(keys_mask, a.dtype)
         a = tf.nn.softmax(a, axis=-1)
         return a
 
@@ -2625,11 +3266,10 @@ class ScaledDotProductAttention(VectorSequenceAttention):
         super().__init__(hsz)
 
     def _attention(self, query_t, keys_bth, keys_mask):
-        a = keys_bth @ tf.expand_dims(query_t, 2)
-        a = a / math.sqrt(self.hsz)
-        a = tf.squeeze(a, -1)
+        # Scale the query rather than the scores, it is [B, H] instead of [B, T]
+        a = tf.linalg.matvec(keys_bth, query_t * (1.0 / math.sqrt(self.hsz)))
         if keys_mask is not None:
-            masked_fill(a, keys_mask == 0, -1e9)
+            a += keys_mask_bias(keys_mask, a.dtype)
         a = tf.nn.softmax(a, axis=-1)
         return a
 
@@ -2640,10 +3280,9 @@ class LuongGeneralAttention(VectorSequenceAttention):
         self.W_a = tf.keras.layers.Dense(self.hsz, use_bias=False)
 
     def _attention(self, query_t, keys_bth, keys_mask):
-        a = keys_bth @ tf.expand_dims(self.W_a(query_t), 2)
-        a = tf.squeeze(a, -1)
+        a = tf.linalg.matvec(keys_bth, self.W_a(query_t))
         if keys_mask is not None:
-            masked_fill(a, keys_mask == 0, -1e9)
+            a += keys_mask_bias(keys_mask, a.dtype)
         a = tf.nn.softmax(a, axis=-1)
         return a
 
@@ -2656,16 +3295,25 @@ class BahdanauAttention(VectorSequenceAttention):
         self.E_a = tf.keras.layers.Dense(self.hsz, use_bias=False)
         self.v = tf.keras.layers.Dense(1, use_bias=False)
 
+    def project_keys(self, keys_bth):
+        return self.E_a(keys_bth)
+
     def _attention(self, query_t, keys_bth, keys_mask):
-        B, T, H = get_shape_as_list(keys_bth)
-        q = tf.reshape(self.W_a(query_t), [B, 1, H])
-        u = self.E_a(keys_bth)
+        """
+        :param query_t: The query `[B, H]`
+        :param keys_bth: The keys, already projected by `project_keys`
+        :param keys_mask: The `[B, T]` keys mask
+        :return: The attention weights `[B, T]`
+        """
+        q = tf.expand_dims(self.W_a(query_t), 1)
 
-        z = tf.nn.tanh(q + u)
-        a = tf.squeeze(self.v(z), -1)
+        z = tf.nn.tanh(q + keys_bth)
+        # `v` only has a single output, so contract it straight to the [B, T] scores rather than [B, T, 1] and squeeze
+        _build_layer(self.v, z.shape)
+        a = tf.einsum("bth,ho->bt", z, self.v.kernel)
 
         if keys_mask is not None:
-            masked_fill(a, keys_mask == 0, -1e9)
+            a += keys_mask_bias(keys_mask, a.dtype)
         a = tf.nn.softmax(a, axis=-1)
         return a
 
@@ -2678,15 +3326,25 @@ class BahdanauAttention(VectorSequenceAttention):
         B, T_k = get_shape_as_list(a)
         a = tf.reshape(a, [B, 1, T_k])
         c_t = tf.squeeze(a @ values_bth, 1)
-        attended = tf.concat([c_t, query_t], -1)
-        attended = self.W_c(attended)
+        attended = self._project_context(c_t, query_t)
         return attended
 
 
+@lru_cache(maxsize=32)
+def _subsequent_mask_array(size: int) -> np.ndarray:
+    mask = np.tril(np.ones((1, 1, size, size), dtype=np.float32))
+    mask.flags.writeable = False
+    return mask
+
+
 def subsequent_mask(size: int):
-    b = tf.compat.v1.matrix_band_part(tf.ones([size, size]), -1, 0)
-    m = tf.reshape(b, [1, 1, size, size])
-    return m
+    if isinstance(size, int):
+        # A static size is a constant the graph can fold, so build it once in numpy and reuse it
+        return tf.constant(_subsequent_mask_array(size))
+    # Compare the positions rather than masking a materialized matrix of ones
+    seq = tf.range(size)
+    m = tf.cast(tf.expand_dims(seq, 1) >= tf.expand_dims(seq, 0), tf.float32)
+    return tf.reshape(m, [1, 1, size, size])
 
 
 def gnmt_length_penalty(lengths, alpha=0.8):
@@ -2700,15 +3358,16 @@ def gnmt_length_penalty(lengths, alpha=0.8):
         parameter.
 
     :returns:
-        `torch.FloatTensor`: [B, K, 1] The penalties.
+        `tf.Tensor`: [B, K, 1] The penalties.
     """
-    penalty = tf.constant(np.power(((5.0 + lengths) / 6.0), alpha))
+    # Computing this on the device avoids a round trip through numpy and a new constant at every step
+    penalty = tf.pow((5.0 + tf.cast(lengths, tf.float32)) / 6.0, alpha)
     return tf.expand_dims(penalty, -1)
 
 
 def no_length_penalty(lengths):
     """A dummy function that returns a no penalty (1)."""
-    return tf.expand_dims(np.ones_like(lengths), -1)
+    return tf.expand_dims(tf.ones_like(lengths), -1)
 
 
 def repeat_batch(t, K, dim=0):
@@ -2734,6 +3393,9 @@ def repeat_batch(t, K, dim=0):
 		[5, 6, 7, 8, 9],
 		[5, 6, 7, 8, 9]])
     """
+    if hasattr(tf, "repeat"):
+        # With a single repeat count this is one broadcast and reshape, and there is no tiling multiple to build
+        return tf.repeat(t, K, axis=dim)
     shape = get_shape_as_list(t)
     tiling = [1] * (len(shape) + 1)
     tiling[dim + 1] = K
@@ -2772,6 +3434,7 @@ class BeamSearchBase:
     def __init__(self, beam: int = 1, length_penalty=None, **kwargs):
         self.length_penalty = length_penalty if length_penalty else no_length_penalty
         self.K = beam
+        self._select_beams = tf_function(jit_compile=None)(self._select_beams)
 
     def init(self, encoder_outputs):
         pass
@@ -2782,6 +3445,66 @@ class BeamSearchBase:
     def update(self, beams, extra):
         pass
 
+    def _select_beams(self, probs, log_probs, lengths, penalty, done_scores, offsets, i):
+        """Score the extensions of each beam and keep the best `K`, as a single traced step (XLA compiled with `set_tf_jit_compile`)
+
+        :param probs: The log probabilities of the next token `[B, K, V]`
+        :param log_probs: The log probability of each beam so far `[B, K]`
+        :param lengths: The lengths of the beams, zero if unfinished `[B, K]`
+        :param penalty: The length penalty for each beam `[B, K, 1]`
+        :param done_scores: The `[1, 1, V]` scores for finished beams, `0` for EOS and `-1e8` for the rest
+        :param offsets: The `[B, 1]` offset of each batch element's first beam in the flattened beams
+        :param i: The (``int32`` tensor) decoding step, a tensor so each step doesn't cause a retrace
+        :returns: The new `log_probs`, the new `lengths`, the `[B, K]` index of the beam each new beam extends, the
+            same as a `[B * K]` global index (for `update`), the `[B, K]` selected tokens, the `[B, K]` scores of
+            the new beams and whether every beam is done
+        """
+        bsz, _, V = get_shape_as_list(probs)
+        # This mask is for all beams that are done.
+        done_mask = tf.expand_dims(lengths != 0, -1)  # [B, K, 1]
+        # Put all probability mass on the EOS token for finished beams.
+        # Otherwise as the other beams get longer they will all give
+        # up and eventually select this beam and all outputs become
+        # the same.
+        probs = tf.compat.v2.where(done_mask, done_scores, probs)
+        probs = tf.expand_dims(log_probs, -1) + probs  # [B, K, V]
+        path_scores = probs / penalty
+        # On the first step we only look at probabilities for the first beam.
+        # If we don't then the probs will be the same for each beam
+        # This means the same token will be selected for each beam
+        # And we won't get any diversity.
+        # Using only the first beam ensures K different starting points.
+        other_beams = tf.reshape((i == 0) & (tf.range(self.K) > 0), (1, self.K, 1))
+        path_scores = masked_fill(path_scores, other_beams, -np.inf)
+
+        # The best K overall are among the best K of each beam, so take those first and then only merge K * K
+        # candidates rather than top_k over all K * V.  Ties still go to the lower beam and then the lower token
+        k = min(self.K, V) if isinstance(V, int) else self.K
+        beam_scores, beam_idx = tf.math.top_k(path_scores, k)  # [B, K, k]
+        flat_scores = tf.reshape(beam_scores, (bsz, -1))  # [B, K * k]
+        best_scores, best = tf.math.top_k(flat_scores, self.K)
+        best_beams = best // k  # Get which beam it came from
+        # Get the index of the word regardless of which beam it is.
+        best_idx = gather_k(flat_scores, tf.reshape(beam_idx, (bsz, -1)), best, self.K)
+        # Get the log_probs of the best scoring beams
+        probs = tf.reshape(probs, (bsz, -1))
+        log_probs = gather_k(flat_scores, probs, best_beams * V + best_idx, self.K)
+
+        # Best Beam index is relative within the batch (only [0, K)).
+        # This makes the index global (e.g. best beams for the second
+        # batch example is in [K, 2*K)).
+        offset_beams = best_beams + offsets
+        flat_beams = tf.reshape(offset_beams, [bsz * self.K])
+
+        # Select the lengths to keep tracking based on the valid beams left.
+        lengths = tf.gather(lengths, best_beams, batch_dims=1)
+        # Updated lengths based on if we hit EOS
+        eoses = best_idx == Offsets.EOS
+        lengths = update_lengths(lengths, eoses, i + 1)
+        # Reduce the stopping check here too, so the loop only pulls back a single flag
+        done = tf.reduce_all(lengths != 0)
+        return log_probs, lengths, best_beams, flat_beams, best_idx, best_scores, done
+
     def __call__(self, encoder_outputs, **kwargs):
         """Perform batched Beam Search.
 
@@ -2828,73 +3551,26 @@ class BeamSearchBase:
             probs, extra = self.step(paths, extra)
             V = get_shape_as_list(probs)[-1]
             probs = tf.reshape(probs, (bsz, self.K, V))  # [B, K, V]
-            if i > 0:
-                # This mask is for all beams that are done.
-                done_mask = lengths != 0  # [B, K, 1]
-                done_mask = tf.expand_dims(done_mask, -1)
-                # Can creating this mask be moved out of the loop? It never changes but we don't have V
-                # This mask selects the EOS token
-                eos_mask = tf.cast(
-                    tf.zeros((1, 1, V)) + tf.reshape(tf.cast(tf.range(V) == Offsets.EOS, tf.float32), (1, 1, V)),
-                    done_mask.dtype,
-                )
-                # eos_mask[:, :, Offsets.EOS] = 1
-                # This mask selects the EOS token of only the beams that are done.
-                mask = done_mask & eos_mask
-                # Put all probability mass on the EOS token for finished beams.
-                # Otherwise as the other beams get longer they will all give
-                # up and eventually select this beam and all outputs become
-                # the same.
-                probs = masked_fill(probs, done_mask, -1e8)
-                probs = masked_fill(probs, mask, 0)
-                probs = tf.expand_dims(log_probs, -1) + probs  # [B, K, V]
-                # Calculate the score of the beam based on the current length.
-                valid_lengths = masked_fill(lengths, lengths == 0, i + 1)
-                path_scores = probs / tf.cast(self.length_penalty(valid_lengths), tf.float32)
-            else:
-                # On the first step we only look at probabilities for the first beam.
-                # If we don't then the probs will be the same for each beam
-                # This means the same token will be selected for each beam
-                # And we won't get any diversity.
-                # Using only the first beam ensures K different starting points.
-                path_scores = probs[:, 0, :]
-
-            flat_scores = tf.reshape(path_scores, (bsz, -1))  # [B, K * V]
-            best_scores, best_idx = tf.math.top_k(flat_scores, self.K)
-            # Get the log_probs of the best scoring beams
-            probs = tf.reshape(probs, (bsz, -1))
-            log_probs = gather_k(flat_scores, probs, best_idx, self.K)
-            log_probs = tf.reshape(log_probs, (bsz, self.K))
-
-            best_beams = best_idx // V  # Get which beam it came from
-            best_idx = best_idx % V  # Get the index of the word regardless of which beam it is.
-
-            # Best Beam index is relative within the batch (only [0, K)).
-            # This makes the index global (e.g. best beams for the second
-            # batch example is in [K, 2*K)).
-            offsets = tf.range(bsz) * self.K
-            offset_beams = best_beams + tf.expand_dims(offsets, -1)
-            flat_beams = tf.reshape(offset_beams, [bsz * self.K])
+            if i == 0:
+                # These never change, but we don't have V until the first step
+                eos_mask = tf.reshape(tf.range(V) == Offsets.EOS, (1, 1, V))
+                done_scores = masked_fill(tf.fill((1, 1, V), -1e8), eos_mask, 0)
+                offsets = tf.expand_dims(tf.range(bsz) * self.K, -1)
+            # Calculate the score of the beam based on the current length.  The penalty can be any callable so it
+            # is run outside of the compiled selection
+            valid_lengths = masked_fill(lengths, lengths == 0, i + 1)
+            penalty = tf.cast(self.length_penalty(valid_lengths), tf.float32)
+            log_probs, lengths, best_beams, flat_beams, best_idx, best_scores, done = self._select_beams(
+                probs, log_probs, lengths, penalty, done_scores, offsets, tf.constant(i)
+            )
             # Select the paths to extend based on the best beams
-            flat_paths = tf.reshape(paths, [bsz * self.K, -1])
-            new_paths = tf.gather(flat_paths, flat_beams)
-            new_paths = tf.reshape(new_paths, [bsz, self.K, -1])
+            new_paths = tf.gather(paths, best_beams, batch_dims=1)
             # Add the selected outputs to the paths
             paths = tf.concat([new_paths, tf.expand_dims(best_idx, -1)], axis=2)
-
-            # Select the lengths to keep tracking based on the valid beams left.
-            ##
-            flat_lengths = tf.reshape(lengths, [-1])
-            lengths = tf.gather(flat_lengths, flat_beams)
-            lengths = tf.reshape(lengths, (bsz, self.K))
             extra = self.update(flat_beams, extra)
 
-            # Updated lengths based on if we hit EOS
-            last = paths[:, :, -1]
-            eoses = last == Offsets.EOS
-            ##
-            lengths = update_lengths(lengths, eoses, i + 1)
-            if tf.reduce_sum(tf.cast(lengths != 0, np.int32)) == self.K:
+            # `step` and `update` can be any python, so the loop stays on the host and checks the flag each step
+            if done:
                 break
         else:
             # This runs if the loop didn't break meaning one beam hit the max len
@@ -2927,6 +3603,7 @@ class StackedLSTMCell(tf.keras.layers.AbstractRNNCell):
 
         for i in range(num_layers):
             self.layers.append(tf.keras.layers.LSTMCell(rnn_size, use_bias=False))
+        self._call = tf_function(jit_compile=None)(self._call)
 
     @property
     def state_size(self):
@@ -2943,12 +3620,17 @@ class StackedLSTMCell(tf.keras.layers.AbstractRNNCell):
         return self.rnn_size
 
     def call(self, input, hidden):
+        return self._call(input, hidden, TRAIN_FLAG())
+
+    def _call(self, input, hidden, training):
+        # This runs once per decoding step, so trace the whole stack of layers at once (with `set_tf_jit_compile` XLA
+        # fuses it into a few kernels).  Whole sequences should use the cuDNN backed encoders (`LSTMEncoderSequence`)
         h_0, c_0 = hidden
         hs, cs = [], []
         for i, layer in enumerate(self.layers):
             input, (h_i, c_i) = layer(input, (h_0[i], c_0[i]))
             if i != self.num_layers - 1:
-                input = self.dropout(input)
+                input = self.dropout(input, training=training)
             hs.append(h_i)
             cs.append(c_i)
 
@@ -2968,14 +3650,18 @@ class StackedGRUCell(tf.keras.layers.AbstractRNNCell):
 
         for i in range(num_layers):
             self.layers.append(tf.keras.layers.GRUCell(rnn_size))
+        self._call = tf_function(jit_compile=None)(self._call)
 
     def call(self, input, hidden):
+        return self._call(input, hidden, TRAIN_FLAG())
+
+    def _call(self, input, hidden, training):
         h_0 = hidden
         hs = []
         for i, layer in enumerate(self.layers):
-            input, h_i = layer(input, h_0)
-            if i != self.num_layers:
-                input = self.dropout(input)
+            input, h_i = layer(input, h_0[i])
+            if i != self.num_layers - 1:
+                input = self.dropout(input, training=training)
             hs.append(h_i)
 
         hs = tf.stack(hs)
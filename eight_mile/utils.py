@@ -7,6 +7,7 @@ import logging
 import inspect
 import importlib
 import collections
+import collections.abc
 from itertools import chain
 from binascii import hexlify
 from functools import partial
@@ -347,7 +348,7 @@ def str2bool(v):
 def is_sequence(x) -> bool:
     if isinstance(x, str):
         return False
-    return isinstance(x, (collections.Sequence, collections.MappingView))
+    return isinstance(x, (collections.abc.Sequence, collections.abc.MappingView))
 
 
 @export
@@ -6,7 +6,7 @@ from eight_mile.utils import get_version
 
 tf = pytest.importorskip("tensorflow")
 pytestmark = pytest.mark.skipif(get_version(tf) < 2, reason="TF1.X")
-from eight_mile.tf.layers import BeamSearchBase, repeat_batch
+from eight_mile.tf.layers import BeamSearchBase, repeat_batch, gnmt_length_penalty
 
 B = 1
 V = 3  # It has to be at least 3 for Offsets.EOS
@@ -105,3 +105,76 @@ def test_beam_lengths():
     paths = paths.numpy().squeeze()
     assert np.allclose(paths[0], np.array(BEST_2_1ST))
     assert np.allclose(paths[1], np.array(BEST_2_2ND))
+
+
+def test_beam_selection_traced_once():
+    encoder = namedtuple("EncoderOutput", "output src_mask")
+    encoder.output = np.zeros((B, V), dtype=np.float32)
+    mbs = MockBeamSearch(PATH_1)
+    mbs(encoder)
+    assert mbs.i == len(PATH_1)
+    assert mbs._select_beams.experimental_get_tracing_count() == 1
+
+
+@pytest.mark.parametrize("dim", [0, 1])
+def test_repeat_batch(dim):
+    t = tf.reshape(tf.range(24), (2, 3, 4))
+    res = repeat_batch(t, 3, dim=dim).numpy()
+    np.testing.assert_array_equal(res, np.repeat(t.numpy(), 3, axis=dim))
+
+
+class MockBatchBeamSearch(BeamSearchBase):
+    def __init__(self, path_dists):
+        super().__init__(beam=K)
+        self.path_dists = path_dists
+        self.i = 0
+
+    def step(self, paths, _):
+        probs = np.array([path_dist[self.i] for path_dist in self.path_dists], dtype=np.float32)
+        self.i += 1
+        return repeat_batch(tf.convert_to_tensor(np.log(probs)), self.K), None
+
+    def update(self, beams, _):
+        return None
+
+
+# Both beams finish after two steps
+PATH_3 = [[0.1, 0.1, 0.8], [0.1, 0.1, 0.8], [0.1, 0.1, 0.8], [0.1, 0.1, 0.8]]
+
+
+@pytest.mark.parametrize("path_dists", [[PATH_1, PATH_2], [PATH_3, PATH_1]])
+def test_beam_batch_matches_single(path_dists):
+    encoder = namedtuple("EncoderOutput", "output src_mask")
+    encoder.output = np.zeros((2, V), dtype=np.float32)
+    paths, lengths, scores = MockBatchBeamSearch(path_dists)(encoder, mxlen=len(PATH_1))
+    for b, path_dist in enumerate(path_dists):
+        encoder.output = np.zeros((1, V), dtype=np.float32)
+        gold_paths, gold_lengths, gold_scores = MockBatchBeamSearch([path_dist])(encoder, mxlen=len(PATH_1))
+        # The search keeps going while any example has an unfinished beam, so finished paths get padded out
+        np.testing.assert_array_equal(paths[b, :, : gold_paths.shape[-1]].numpy(), gold_paths[0].numpy())
+        np.testing.assert_array_equal(lengths[b].numpy(), gold_lengths[0].numpy())
+        np.testing.assert_allclose(scores[b].numpy(), gold_scores[0].numpy(), rtol=1e-5)
+
+
+def test_gnmt_length_penalty():
+    lengths = np.array([[1, 2], [7, 30]])
+    gold = np.power((5.0 + lengths) / 6.0, 0.6)[..., np.newaxis]
+    np.testing.assert_allclose(gnmt_length_penalty(lengths, 0.6).numpy(), gold, rtol=1e-5)
+    np.testing.assert_allclose(gnmt_length_penalty(tf.constant(lengths), 0.6).numpy(), gold, rtol=1e-5)
+
+
+def test_beam_selection_matches_flat_top_k():
+    bsz, beam, vocab = 3, 4, 50
+    search = BeamSearchBase(beam=beam)
+    probs = tf.nn.log_softmax(tf.random.normal((bsz, beam, vocab)))
+    log_probs = tf.random.normal((bsz, beam))
+    lengths = tf.zeros((bsz, beam), tf.int32)
+    done_scores = tf.zeros((1, 1, vocab))
+    offsets = tf.expand_dims(tf.range(bsz) * beam, -1)
+    penalty = tf.ones((bsz, beam, 1))
+    res = search._select_beams(probs, log_probs, lengths, penalty, done_scores, offsets, tf.constant(1))
+    _, _, best_beams, _, best_idx, best_scores, _ = res
+    gold_scores, gold_flat = tf.math.top_k(tf.reshape(tf.expand_dims(log_probs, -1) + probs, (bsz, -1)), beam)
+    np.testing.assert_allclose(best_scores.numpy(), gold_scores.numpy(), rtol=1e-6)
+    np.testing.assert_array_equal(best_beams.numpy(), gold_flat.numpy() // vocab)
+    np.testing.assert_array_equal(best_idx.numpy(), gold_flat.numpy() % vocab)
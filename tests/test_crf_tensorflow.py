@@ -1,17 +1,24 @@
 import os
 import json
 import pytest
-
-pytest.skip("There is now a crf object we should be testing on instead of the tagger", allow_module_level=True)
 import numpy as np
 
 tf = pytest.importorskip("tensorflow")
-from baseline.model import create_tagger_model, load_tagger_model
-from baseline.embeddings import load_embeddings
-from baseline.utils import transition_mask as np_transition_mask
-from baseline.tf.tfy import transition_mask
-
-
+from eight_mile.utils import get_version, Offsets
+from eight_mile.tf.layers import (
+    CRF,
+    TaggerGreedyDecoder,
+    MultiHeadedAttention,
+    set_tf_mixed_precision,
+    crf_decode,
+)
+
+# The tagger tests below need `baseline`
+skip_tagger = pytest.mark.skip(reason="There is now a crf object we should be testing on instead of the tagger")
+
+B = 6
+T = 9
+H = 12
 HSZ = 100
 WSZ = 30
 S = "<GO>"
@@ -35,9 +42,15 @@ def label_vocab():
     return json.load(open(vocab_loc))
 
 
+@pytest.fixture
+def inputs():
+    return tf.random.normal(shape=(B, T, H))
+
+
 @pytest.fixture
 def embeds():
     import baseline.tf.embeddings
+    from baseline.embeddings import load_embeddings
 
     embeds = {}
     embeds["word"] = load_embeddings("word", dsz=HSZ, known_vocab={chr(i): i for i in range(100)})["embeddings"]
@@ -58,6 +71,7 @@ def save_file():
 
 @pytest.fixture
 def model(label_vocab, embeds, mask):
+    from baseline.model import create_tagger_model
     from baseline.tf import tagger
 
     model = create_tagger_model(
@@ -70,21 +84,30 @@ def model(label_vocab, embeds, mask):
 
 @pytest.fixture
 def mask(label_vocab):
+    from baseline.tf.tfy import transition_mask
+
     return transition_mask(label_vocab, SPAN_TYPE, label_vocab[S], label_vocab[E], label_vocab[P])
 
 
+@skip_tagger
 def test_mask_used(label_vocab, model):
     transition = model.sess.run(model.A)
     assert transition[label_vocab["O"], label_vocab[S]] == -1e4
 
 
+@skip_tagger
 def test_mask_is_transpose(label_vocab, model):
+    from baseline.utils import transition_mask as np_transition_mask
+
     transition = model.sess.run(model.mask)
     np_mask = np_transition_mask(label_vocab, SPAN_TYPE, label_vocab[S], label_vocab[E], label_vocab[P])
     np.testing.assert_allclose(transition.T, np_mask)
 
 
+@skip_tagger
 def test_persists_save(model, save_file):
+    from baseline.model import load_tagger_model
+
     model.save_using(tf.compat.v1.train.Saver())
     t1 = model.sess.run(model.A)
     model.save(save_file)
@@ -93,7 +116,9 @@ def test_persists_save(model, save_file):
     np.testing.assert_allclose(t1, t2)
 
 
+@skip_tagger
 def test_skip_mask(label_vocab, embeds, mask):
+    from baseline.model import create_tagger_model
     from baseline.tf import tagger
 
     model = create_tagger_model(embeds, label_vocab, crf=True, hsz=HSZ, cfiltsz=[3], wsz=WSZ, layers=2, rnntype="blstm")
@@ -101,3 +126,80 @@ def test_skip_mask(label_vocab, embeds, mask):
     model.sess.run(tf.compat.v1.global_variables_initializer())
     transition = model.sess.run(model.A)
     assert transition[label_vocab["O"], label_vocab[S]] != -1e4
+
+
+@pytest.mark.skipif(get_version(tf) < 2, reason="needs tf2")
+def test_crf_neg_log_loss_with_constraints():
+    N = 5
+    mask = np.ones((N, N), dtype=np.float32)
+    mask[1, 2] = 0
+    crf = CRF(N, constraint_mask=(tf.constant(mask), tf.constant(1 - mask)))
+    unary = tf.random.normal((3, 4, N))
+    tags = tf.constant([[1, 3, 3, 0], [2, 2, 0, 0], [4, 1, 1, 3]])
+    lengths = tf.constant([4, 2, 3])
+    expected = -tf.reduce_mean(crf.score_sentence(unary, tags, lengths) - crf((unary, lengths), training=True))
+    np.testing.assert_allclose(crf.neg_log_loss(unary, tags, lengths).numpy(), expected.numpy(), rtol=1e-5)
+
+
+@pytest.mark.skipif(get_version(tf) < 2, reason="needs tf2")
+def test_tag_decoders_start_from_go():
+    N = 5
+    mask = np.ones((N, N), dtype=np.float32)
+    mask[1, 2] = 0
+    unary = tf.random.normal((3, 4, N))
+    lengths = tf.constant([4, 2, 3])
+    for decoder in (CRF(N, constraint_mask=(mask, 1 - mask)), TaggerGreedyDecoder(N, constraint_mask=(mask, 1 - mask))):
+        gos = np.full((1, 1, N), -1e4, dtype=np.float32)
+        gos[:, :, Offsets.GO] = 0
+        if isinstance(decoder, CRF):
+            gos = tf.nn.log_softmax(gos, axis=-1)
+            best, scores = decoder.decode(unary, lengths)
+        else:
+            best, scores = decoder((unary, lengths))
+        probv = tf.concat([tf.tile(gos, [3, 1, 1]), unary], axis=1)
+        gold, gold_scores = crf_decode(probv, decoder.transitions, lengths + 1)
+        np.testing.assert_array_equal(best.numpy(), gold[:, 1:].numpy())
+        np.testing.assert_allclose(scores.numpy(), gold_scores.numpy(), rtol=1e-5)
+
+
+@pytest.mark.skipif(get_version(tf) < 2, reason="needs tf2")
+def test_crf_finalize_for_inference():
+    N = 5
+    mask = np.ones((N, N), dtype=np.float32)
+    mask[1, 2] = 0
+    crf = CRF(N, constraint_mask=(mask, 1 - mask))
+    unary = tf.random.normal((3, 4, N))
+    lengths = tf.constant([4, 2, 3])
+    best, scores = crf.decode(unary, lengths)
+    crf.finalize_for_inference()
+    np.testing.assert_allclose(crf.transitions.numpy(), (crf.A * mask + (1 - mask) * -1e4).numpy())
+    crf.A.assign(tf.zeros_like(crf.A))
+    frozen_best, frozen_scores = crf.decode(unary, lengths)
+    np.testing.assert_array_equal(frozen_best.numpy(), best.numpy())
+    np.testing.assert_allclose(frozen_scores.numpy(), scores.numpy(), rtol=1e-5)
+
+
+@pytest.mark.skipif(get_version(tf) < 2, reason="needs tf2")
+def test_mixed_bfloat16_keeps_decoders_in_float32(inputs):
+    N = 5
+    mask = np.ones((N, N), dtype=np.float32)
+    mask[1, 2] = 0
+    tags = tf.constant([[1, 3, 3, 0], [2, 2, 0, 0], [4, 1, 1, 3]])
+    lengths = tf.constant([4, 2, 3])
+    try:
+        set_tf_mixed_precision("mixed_bfloat16")
+        attn = MultiHeadedAttention(2, H, dropout=0.0, scale=True)
+        assert attn((inputs, inputs, inputs, None)).dtype == tf.bfloat16
+        unary = tf.keras.layers.Dense(N)(tf.random.normal((3, 4, H)))
+        assert unary.dtype == tf.bfloat16
+        crf = CRF(N, constraint_mask=(mask, 1 - mask))
+        greedy = TaggerGreedyDecoder(N, constraint_mask=(mask, 1 - mask))
+        assert crf.neg_log_loss(unary, tags, lengths).dtype == tf.float32
+        assert crf.decode(unary, lengths)[1].dtype == tf.float32
+        assert greedy((unary, lengths))[1].dtype == tf.float32
+    finally:
+        set_tf_mixed_precision("float32")
+    gold = CRF(N, constraint_mask=(mask, 1 - mask))
+    gold.set_weights(crf.get_weights())
+    expected = gold.neg_log_loss(tf.cast(unary, tf.float32), tags, lengths)
+    np.testing.assert_allclose(crf.neg_log_loss(unary, tags, lengths).numpy(), expected.numpy(), rtol=1e-5)
@@ -0,0 +1,20 @@
+import pytest
+from eight_mile.utils import get_version
+
+tf = pytest.importorskip("tensorflow")
+pytestmark = pytest.mark.skipif(get_version(tf) >= 2, reason="TF2.0")
+from eight_mile.tf.layers import LSTMEncoderSequence1, BiLSTMEncoderSequence1
+
+
+@pytest.mark.parametrize("encoder_cls", [LSTMEncoderSequence1, BiLSTMEncoderSequence1])
+def test_cudnn_weights_built_outside_train_flag_cond(encoder_cls):
+    with tf.Graph().as_default():
+        inputs = tf.compat.v1.placeholder(tf.float32, [None, None, 10])
+        lengths = tf.compat.v1.placeholder(tf.int32, [None])
+        encoder = encoder_cls(10, 8, 2, pdrop=0.5, use_cudnn=True)
+        rnnout = encoder((inputs, lengths))
+        assert rnnout.get_shape().as_list() == [None, None, 8]
+        # Both branches of the train flag share one set of weights, built before the cond
+        variables = tf.compat.v1.trainable_variables()
+        assert len(variables) == 1
+        assert "cond" not in variables[0].initializer.name
@@ -120,6 +120,29 @@ def test_mmap_w2v():
     np.testing.assert_allclose(wv_file.weights, wv_mmap.weights)
 
 
+def test_parallel_glove():
+    wv_file = PretrainedEmbeddingsModel(GLOVE_FILE, keep_unused=True)
+    wv_parallel = PretrainedEmbeddingsModel(GLOVE_FILE, keep_unused=True, workers=3)
+    assert wv_file.vocab == wv_parallel.vocab
+    np.testing.assert_allclose(wv_file.weights[Offsets.OFFSET :], wv_parallel.weights[Offsets.OFFSET :])
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"use_mmap": True}, {"workers": 3}])
+def test_glove_all_filtered(kwargs):
+    wv = PretrainedEmbeddingsModel(GLOVE_FILE, known_vocab={"zzzzzzzzzzz": 1}, **kwargs)
+    assert wv.weights.shape == (Offsets.OFFSET + 1, wv.get_dsz())
+    assert wv.get_dsz() == PretrainedEmbeddingsModel(GLOVE_FILE, keep_unused=True).get_dsz()
+
+
+@pytest.mark.parametrize("kwargs", [{}, {"use_mmap": True}, {"workers": 3}])
+def test_glove_header_only(tmpdir, kwargs):
+    glove_file = str(tmpdir.join("empty.txt"))
+    with open(glove_file, "w") as f:
+        f.write("0 5\n")
+    wv = PretrainedEmbeddingsModel(glove_file, keep_unused=True, **kwargs)
+    assert wv.weights.shape == (Offsets.OFFSET, 5)
+
+
 def test_normalize_e2e():
     wv = random_model()(normalize=True, keep_unused=True)
     norms = np.sqrt(np.sum(np.square(wv.weights), 1))
@@ -137,6 +160,40 @@ def test_normalize():
     np.testing.assert_allclose(normed, gold_norms)
 
 
+def test_normalize_copy():
+    wv = random_model()(keep_unused=True)
+    weights = wv.weights.copy()
+    norm_weights(wv.weights)
+    np.testing.assert_equal(wv.weights, weights)
+
+
+def test_normalize_inplace():
+    wv = random_model()(keep_unused=True)
+    gold = norm_weights(wv.weights)
+    normed = norm_weights(wv.weights, copy=False)
+    assert normed is wv.weights
+    np.testing.assert_allclose(normed, gold)
+
+
+def test_weights_file_npz(tmpdir):
+    wv = random_model()(keep_unused=True)
+    weights_file = str(tmpdir.join("weights.npz"))
+    wv.save_weights(weights_file)
+    loaded = WordEmbeddingsModel(weights_file=weights_file, use_mmap=True)
+    np.testing.assert_equal(loaded.weights, wv.weights)
+
+
+def test_weights_file_npy_mmap(tmpdir):
+    wv = random_model()(keep_unused=True)
+    weights_file = str(tmpdir.join("weights.npy"))
+    np.save(weights_file, wv.weights)
+    loaded = WordEmbeddingsModel(weights_file=weights_file, use_mmap=True)
+    assert isinstance(loaded.weights, np.memmap)
+    assert loaded.get_vsz() == wv.get_vsz()
+    assert loaded.get_dsz() == wv.get_dsz()
+    np.testing.assert_equal(loaded.weights, wv.weights)
+
+
 # def test_vocab_truncation():
 #     model = random_model()
 #     wv = model(keep_unused=True)
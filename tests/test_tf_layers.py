@@ -0,0 +1,297 @@
+import pytest
+import numpy as np
+
+tf = pytest.importorskip("tensorflow")
+from eight_mile.utils import get_version
+
+pytestmark = pytest.mark.skipif(get_version(tf) < 2, reason="needs tf2")
+from eight_mile.tf.layers import (
+    ParallelConv,
+    ConvEncoder,
+    ConvEncoderStack,
+    LSTMEncoderSequence2,
+    LSTMEncoderWithState2,
+    LSTMEncoderAll2,
+    BiLSTMEncoderAll2,
+    BiLSTMEncoderSequence2,
+    MeanPool1D,
+    FFN,
+    WeightTieDense,
+    TimeDistributedProjection,
+    Highway,
+    DenseStack,
+    StackedLSTMCell,
+    StackedGRUCell,
+    set_tf_mixed_precision,
+    set_tf_jit_compile,
+    EmbeddingsStack,
+    SET_TRAIN_FLAG,
+    gelu,
+)
+
+B = 6
+T = 9
+H = 12
+
+
+@pytest.fixture
+def inputs():
+    return tf.random.normal(shape=(B, T, H))
+
+
+def parallel_conv_reference(conv, inputs):
+    """Run each filter width as its own conv, the way `ParallelConv` used to"""
+    expanded = tf.expand_dims(inputs, 1)
+    mots = []
+    for W, b in zip(conv.Ws, conv.bs):
+        conv_out = tf.nn.conv2d(expanded, W, strides=[1, 1, 1, 1], padding="SAME")
+        mots.append(tf.reduce_max(conv.activation(tf.nn.bias_add(conv_out, b)), [2], keepdims=True))
+    return tf.reshape(tf.concat(mots, 3), [-1, conv.output_dim])
+
+
+@pytest.mark.parametrize("filtsz", [[3], [2, 3, 4, 5], [1, 6, 3], [7, 2]])
+def test_parallel_conv_matches_per_filter(inputs, filtsz):
+    conv = ParallelConv(H, 5, filtsz)
+    for b in conv.bs:
+        b.assign(tf.random.normal(b.shape))
+    res = conv(inputs)
+    assert res.shape == (B, 5 * len(filtsz))
+    np.testing.assert_allclose(res.numpy(), parallel_conv_reference(conv, inputs).numpy(), rtol=1e-5, atol=1e-5)
+
+
+def test_parallel_conv_multiple_outsz(inputs):
+    conv = ParallelConv(H, [3, 4, 5], [2, 3, 4])
+    res = conv(inputs)
+    assert res.shape == (B, 12)
+    np.testing.assert_allclose(res.numpy(), parallel_conv_reference(conv, inputs).numpy(), rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("dtype", [tf.float16, "mixed_float16"])
+def test_parallel_conv_half_precision(inputs, dtype):
+    conv = ParallelConv(H, 5, [2, 3], dtype=dtype)
+    full = ParallelConv(H, 5, [2, 3])
+    conv(inputs)
+    full(inputs)
+    for half_var, full_var in zip(conv.Ws + conv.bs, full.Ws + full.bs):
+        full_var.assign(tf.cast(half_var, tf.float32))
+    res = conv(inputs)
+    assert res.dtype == tf.float32
+    np.testing.assert_allclose(res.numpy(), full(inputs).numpy(), rtol=1e-2, atol=1e-2)
+
+
+def test_parallel_conv_follows_global_policy(inputs):
+    try:
+        set_tf_mixed_precision("mixed_bfloat16")
+        conv = ParallelConv(H, 5, [2, 3])
+    finally:
+        set_tf_mixed_precision("float32")
+    assert conv.compute_dtype == "bfloat16"
+    assert conv(inputs).dtype == tf.float32
+
+
+def test_conv_encoder_follows_train_flag(inputs):
+    conv = ConvEncoder(H, 8, 3, pdrop=0.9)
+    try:
+        SET_TRAIN_FLAG(False)
+        eval_res = conv(inputs).numpy()
+        np.testing.assert_allclose(conv(inputs).numpy(), eval_res)
+        SET_TRAIN_FLAG(True)
+        train_res = conv(inputs).numpy()
+        assert (train_res == 0).sum() > (eval_res == 0).sum()
+        SET_TRAIN_FLAG(False)
+        np.testing.assert_allclose(conv(inputs).numpy(), eval_res)
+    finally:
+        SET_TRAIN_FLAG(False)
+
+
+def test_lstm_with_state_zero_state(inputs):
+    lstm = LSTMEncoderWithState2(H, 7, 2)
+    state = lstm.zero_state(B)
+    assert len(state) == 2
+    for h, c in state:
+        assert h.shape == (B, 7) and c.shape == (B, 7)
+    from_zeros, _ = lstm((inputs, state))
+    from_none, _ = lstm((inputs, None))
+    np.testing.assert_allclose(from_zeros.numpy(), from_none.numpy(), rtol=1e-6, atol=1e-6)
+
+
+def test_gelu_tanh_approximation():
+    x = np.linspace(-6, 6, 101).astype(np.float32)
+    gold = 0.5 * x * (1 + np.tanh(np.sqrt(2 / np.pi) * (x + 0.044715 * np.power(x, 3))))
+    np.testing.assert_allclose(gelu(tf.constant(x)).numpy(), gold, rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize("encoder", [LSTMEncoderAll2, BiLSTMEncoderAll2])
+def test_lstm_trims_extra_padding(inputs, encoder):
+    lengths = tf.constant([5, 3, 5, 1, 2, 4])
+    lstm = encoder(H, 8, 1)
+    out, (h, c) = lstm((inputs, lengths))
+    trimmed_out, (trimmed_h, trimmed_c) = lstm((inputs[:, :5], lengths))
+    assert out.shape[:2] == (B, T)
+    np.testing.assert_allclose(out.numpy()[:, :5], trimmed_out.numpy(), rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(h.numpy(), trimmed_h.numpy(), rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(c.numpy(), trimmed_c.numpy(), rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(out.numpy()[:, 5:], 0)
+
+
+@pytest.mark.parametrize("encoder", [LSTMEncoderSequence2, BiLSTMEncoderSequence2])
+def test_lstm_dropout_follows_train_flag(inputs, encoder):
+    lengths = tf.constant([5, 3, 9, 1, 2, 4])
+    lstm = encoder(H, 8, 2, pdrop=0.5)
+    try:
+        SET_TRAIN_FLAG(False)
+        eval_res = lstm((inputs, lengths)).numpy()
+        np.testing.assert_allclose(lstm((inputs, lengths)).numpy(), eval_res)
+        SET_TRAIN_FLAG(True)
+        assert not np.allclose(lstm((inputs, lengths)).numpy(), eval_res)
+        SET_TRAIN_FLAG(False)
+        np.testing.assert_allclose(lstm((inputs, lengths)).numpy(), eval_res)
+    finally:
+        SET_TRAIN_FLAG(False)
+
+
+@pytest.mark.parametrize("jit_compile", [False, True])
+def test_conv_encoder_stack_runs_every_layer(inputs, jit_compile):
+    try:
+        set_tf_jit_compile(jit_compile)
+        stack = ConvEncoderStack(H, 8, 3, 0.0, layers=3)
+    finally:
+        set_tf_jit_compile(False)
+    assert bool(stack._call._jit_compile) == jit_compile
+    res = stack(inputs)
+    assert res.shape == (B, T, 8)
+    assert len(stack.trainable_variables) == 6
+    first, *rest = stack.net.layers
+    x = first(inputs)
+    for layer in rest:
+        x = x + layer.layer(x)
+    np.testing.assert_allclose(res.numpy(), x.numpy(), rtol=1e-5, atol=1e-5)
+
+
+def test_bilstm_all_state_concats_directions(inputs):
+    lengths = tf.constant([5, 3, 5, 1, 2, 4])
+    lstm = BiLSTMEncoderAll2(H, 8, 2)
+    out, (h, c) = lstm((inputs, lengths))
+    assert h.shape == (2, B, 8) and c.shape == (2, B, 8)
+    last = tf.gather(out, lengths - 1, batch_dims=1)
+    np.testing.assert_allclose(h[-1, :, :4].numpy(), last[:, :4].numpy(), rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(h[-1, :, 4:].numpy(), out[:, 0, 4:].numpy(), rtol=1e-5, atol=1e-6)
+
+
+def test_weight_tie_dense_uses_tied_weights(inputs):
+    tied = tf.keras.layers.Layer()
+    tied.W = tf.Variable(tf.random.normal((20, H)))
+    out = WeightTieDense(tied)(inputs)
+    np.testing.assert_allclose(out.numpy(), np.einsum("btd,vd->btv", inputs.numpy(), tied.W.numpy()), atol=1e-4)
+
+
+def test_time_distributed_projection(inputs):
+    proj = TimeDistributedProjection(5)
+    out = proj(inputs)
+    assert out.shape == (B, T, 5)
+    expected = tf.reshape(tf.matmul(tf.reshape(inputs, [-1, H]), proj.W) + proj.b, [B, T, 5])
+    np.testing.assert_allclose(out.numpy(), expected.numpy(), atol=1e-5)
+
+
+def test_highway_gate(inputs):
+    highway = Highway(H)
+    out = highway(inputs)
+    proj, gate = highway.proj(inputs), highway.transform(inputs)
+    np.testing.assert_allclose(out.numpy(), (gate * proj + (1 - gate) * inputs).numpy(), atol=1e-5)
+
+
+def test_dense_stack_follows_train_flag(inputs):
+    stack = DenseStack(H, [16, 8], pdrop_value=0.9)
+    try:
+        SET_TRAIN_FLAG(False)
+        eval_res = stack(inputs).numpy()
+        x = inputs
+        for layer in stack.layer_stack:
+            x = layer(x)
+        np.testing.assert_allclose(eval_res, x.numpy(), rtol=1e-5, atol=1e-5)
+        SET_TRAIN_FLAG(True)
+        assert (stack(inputs).numpy() == 0).sum() > (eval_res == 0).sum()
+    finally:
+        SET_TRAIN_FLAG(False)
+
+
+@pytest.mark.parametrize("jit_compile", [False, True])
+def test_layers_follow_jit_compile_switch(inputs, jit_compile):
+    try:
+        set_tf_jit_compile(jit_compile)
+        layers = [
+            DenseStack(H, [16, 8]),
+            Highway(H),
+            FFN(H, 0.1),
+            MeanPool1D(H),
+            StackedLSTMCell(2, H, 8, 0.1),
+            StackedGRUCell(2, H, 8, 0.1),
+        ]
+    finally:
+        set_tf_jit_compile(False)
+    for layer in layers:
+        assert bool(layer._call._jit_compile) == jit_compile
+    lengths = tf.constant([5, 3, 9, 1, 2, 4])
+    np.testing.assert_allclose(
+        layers[3]((inputs, lengths)).numpy(),
+        (tf.reduce_sum(inputs, 1) / tf.cast(tf.expand_dims(lengths, -1), tf.float32)).numpy(),
+        rtol=1e-5,
+        atol=1e-6,
+    )
+
+
+def test_embeddings_stack_concats_in_order():
+    embeddings = {"word": tf.keras.layers.Embedding(10, 4), "char": tf.keras.layers.Embedding(12, 3)}
+    stack = EmbeddingsStack(embeddings)
+    inputs = {"char": tf.constant([[1, 2, 3]]), "word": tf.constant([[4, 5, 6]])}
+    out = stack(inputs)
+    expected = tf.concat([embeddings["word"](inputs["word"]), embeddings["char"](inputs["char"])], -1)
+    np.testing.assert_allclose(out.numpy(), expected.numpy())
+
+
+def test_mean_pool_over_lengths(inputs):
+    lengths = tf.constant([T, 4, 1, 0, 2, T])
+    # The pooling sums over the whole time dim, so it expects the padding to be zeros
+    inputs = inputs * tf.expand_dims(tf.sequence_mask(lengths, T, dtype=tf.float32), -1)
+    res = MeanPool1D(H)((inputs, lengths)).numpy()
+    for i, length in enumerate(lengths.numpy()):
+        gold = inputs[i, :length].numpy().mean(0) if length else np.zeros(H)
+        np.testing.assert_allclose(res[i], gold, rtol=1e-5, atol=1e-6)
+
+
+def test_stacked_lstm_cell_step():
+    cell = StackedLSTMCell(2, H, 8, 0.5)
+    x = tf.random.normal((B, H))
+    h, c = tf.random.normal((2, B, 8)), tf.random.normal((2, B, 8))
+    try:
+        SET_TRAIN_FLAG(False)
+        out, (hs, cs) = cell(x, (h, c))
+        gold, (h_0, c_0) = cell.layers[0](x, (h[0], c[0]))
+        gold, (h_1, c_1) = cell.layers[1](gold, (h[1], c[1]))
+        np.testing.assert_allclose(out.numpy(), gold.numpy(), rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(hs.numpy(), np.stack([h_0, h_1]), rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(cs.numpy(), np.stack([c_0, c_1]), rtol=1e-5, atol=1e-6)
+        SET_TRAIN_FLAG(True)
+        assert not np.allclose(cell(x, (h, c))[0].numpy(), out.numpy())
+    finally:
+        SET_TRAIN_FLAG(False)
+
+
+def test_stacked_gru_cell_step():
+    cell = StackedGRUCell(2, H, 8, 0.5)
+    x = tf.random.normal((B, H))
+    h = tf.random.normal((2, B, 8))
+    try:
+        SET_TRAIN_FLAG(False)
+        out, hs = cell(x, h)
+        gold, h_0 = cell.layers[0](x, h[0])
+        gold, h_1 = cell.layers[1](gold, h[1])
+        np.testing.assert_allclose(out.numpy(), gold.numpy(), rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(hs.numpy(), np.stack([h_0, h_1]), rtol=1e-5, atol=1e-6)
+        SET_TRAIN_FLAG(True)
+        train_out, train_hs = cell(x, h)
+        # There is no dropout after the last layer
+        np.testing.assert_allclose(train_out.numpy(), train_hs[-1].numpy())
+        assert not np.allclose(train_out.numpy(), out.numpy())
+    finally:
+        SET_TRAIN_FLAG(False)
@@ -1,10 +1,36 @@
 import os
+import math
 import pytest
 import numpy as np
 
 tf = pytest.importorskip("tensorflow")
 from eight_mile.utils import get_version
-from eight_mile.tf.layers import SeqDotProductAttention, SeqScaledDotProductAttention, subsequent_mask
+from eight_mile.tf.layers import (
+    SeqDotProductAttention,
+    SeqScaledDotProductAttention,
+    SeqDotProductRelativeAttention,
+    SeqScaledDotProductRelativeAttention,
+    SeqBlockwiseDotProductAttention,
+    MultiHeadedAttention,
+    MultiHeadedRelativeAttention,
+    TransformerDecoderStack,
+    TransformerEncoderStack,
+    TransformerEncoderStackWithTimeMask,
+    FFN,
+    LayerNormalization,
+    LuongDotProductAttention,
+    ScaledDotProductAttention,
+    LuongGeneralAttention,
+    BahdanauAttention,
+    relative_position_edges,
+    subsequent_mask,
+    set_tf_jit_compile,
+    SET_TRAIN_FLAG,
+)
+
+B = 6
+T = 9
+H = 12
 
 
 @pytest.fixture(scope="module")
@@ -14,6 +40,11 @@ def set_cpu():
     del os.environ["CUDA_VISIBLE_DEVICES"]
 
 
+@pytest.fixture
+def inputs():
+    return tf.random.normal(shape=(B, T, H))
+
+
 @pytest.fixture
 def qkv():
     with tf.device("/cpu:0"):
@@ -134,3 +165,333 @@ def test_scaled_attn_value_sub_mask(qkv):
                     np.testing.assert_allclose(
                         res[b, h, t, :], np.mean(gold[:, :, : t + 1, :], axis=2)[b, h, :], atol=1e-5
                     )
+
+
+def test_causal_attention_requires_block_size():
+    with pytest.raises(ValueError):
+        MultiHeadedAttention(2, H, 0.1, causal=True)
+
+
+@pytest.mark.skipif(get_version(tf) < 2, reason="needs tf2")
+@pytest.mark.parametrize("attn_cls", [SeqDotProductRelativeAttention, SeqScaledDotProductRelativeAttention])
+def test_relative_attention_edges(attn_cls):
+    Hd, D = 3, 4
+    q, k, v = [np.random.randn(B, Hd, T, D).astype(np.float32) for _ in range(3)]
+    ek, ev = [np.random.randn(T, T, D).astype(np.float32) for _ in range(2)]
+    attn = attn_cls(0.0)
+    res = attn((tf.constant(q), tf.constant(k), tf.constant(v), tf.constant(ek), tf.constant(ev), None)).numpy()
+    scores = np.matmul(q, k.transpose(0, 1, 3, 2))
+    for i in range(T):
+        for j in range(T):
+            scores[:, :, i, j] += q[:, :, i] @ ek[i, j]
+    if attn_cls is SeqScaledDotProductRelativeAttention:
+        scores /= np.sqrt(D)
+    a = np.exp(scores - scores.max(-1, keepdims=True))
+    a /= a.sum(-1, keepdims=True)
+    np.testing.assert_allclose(attn.attn.numpy(), a, rtol=1e-4, atol=1e-5)
+    gold = np.matmul(a, v)
+    for i in range(T):
+        gold[:, :, i] += np.einsum("bhj,jd->bhd", a[:, :, i], ev[i])
+    np.testing.assert_allclose(res, gold, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.skipif(get_version(tf) < 2, reason="needs tf2")
+@pytest.mark.parametrize("policy", ["mixed_float16", "mixed_bfloat16"])
+def test_attention_mixed_precision(policy):
+    tf.keras.mixed_precision.set_global_policy(policy)
+    try:
+        attn = MultiHeadedAttention(2, H, dropout=0.0, scale=True)
+        x = tf.random.normal((B, T, H))
+        mask = tf.reshape(tf.sequence_mask([T, 4, 1, 0, 2, T], T, dtype=tf.int32), [B, 1, 1, T])
+        res = attn((x, x, x, mask))
+    finally:
+        tf.keras.mixed_precision.set_global_policy("float32")
+    assert res.dtype == tf.keras.mixed_precision.Policy(policy).compute_dtype
+    assert np.all(np.isfinite(tf.cast(res, tf.float32).numpy()))
+
+
+@pytest.mark.skipif(get_version(tf) < 2, reason="needs tf2")
+def test_self_attention_fused_projection(inputs):
+    attn = MultiHeadedAttention(2, H, dropout=0.0)
+    mask = tf.ones((B, 1, 1, T), dtype=tf.int32)
+    fused = attn((inputs, inputs, inputs, mask))
+    separate = attn((inputs, tf.identity(inputs), tf.identity(inputs), mask))
+    np.testing.assert_allclose(fused.numpy(), separate.numpy(), rtol=1e-5, atol=1e-6)
+    assert [v.name.split("/", 1)[1] for v in attn.trainable_variables[:2]] == [
+        "query_projection/kernel:0",
+        "query_projection/bias:0",
+    ]
+
+
+@pytest.mark.skipif(get_version(tf) < 2, reason="needs tf2")
+def test_scaled_attention_masks_scores():
+    Hd, D = 3, 4
+    q, k, v = [np.random.randn(B, Hd, T, D).astype(np.float32) for _ in range(3)]
+    mask = tf.reshape(tf.sequence_mask([T, 4, 1, 5, 2, T], T, dtype=tf.int32), [B, 1, 1, T])
+    attn = SeqScaledDotProductAttention(0.0)
+    res = attn((tf.constant(q), tf.constant(k), tf.constant(v), mask)).numpy()
+    scores = np.matmul(q, k.transpose(0, 1, 3, 2)) / np.sqrt(D)
+    scores = np.where(mask.numpy() == 0, -1e9, scores)
+    a = np.exp(scores - scores.max(-1, keepdims=True))
+    a /= a.sum(-1, keepdims=True)
+    np.testing.assert_allclose(attn.attn.numpy(), a, rtol=1e-4, atol=1e-5)
+    np.testing.assert_allclose(res, np.matmul(a, v), rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.skipif(get_version(tf) < 2, reason="needs tf2")
+@pytest.mark.parametrize("block_size", [2, 4, T, 32])
+def test_blockwise_attention_matches_full(block_size):
+    Hd, D = 3, 4
+    q, k, v = [tf.random.normal((B, Hd, T, D)) for _ in range(3)]
+    mask = tf.reshape(tf.sequence_mask([T, 4, 1, 0, 2, T], T, dtype=tf.int32), [B, 1, 1, T])
+    subsequent = tf.reshape(tf.linalg.band_part(tf.ones((T, T), dtype=tf.int32), -1, 0), [1, 1, T, T])
+    for m in (None, mask, subsequent):
+        res = SeqBlockwiseDotProductAttention(0.0, block_size=block_size)((q, k, v, m))
+        gold = SeqScaledDotProductAttention(0.0)((q, k, v, m))
+        np.testing.assert_allclose(res.numpy(), gold.numpy(), rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.skipif(get_version(tf) < 2, reason="needs tf2")
+def test_blockwise_attention_dropout_follows_train_flag():
+    q, k, v = [tf.random.normal((B, 2, T, 4)) for _ in range(3)]
+    attn = SeqBlockwiseDotProductAttention(0.5, block_size=4)
+    try:
+        SET_TRAIN_FLAG(False)
+        eval_res = attn((q, k, v, None)).numpy()
+        np.testing.assert_allclose(eval_res, SeqScaledDotProductAttention(0.0)((q, k, v, None)).numpy(), atol=1e-5)
+        SET_TRAIN_FLAG(True)
+        assert not np.allclose(attn((q, k, v, None)).numpy(), eval_res)
+    finally:
+        SET_TRAIN_FLAG(False)
+
+
+@pytest.mark.skipif(get_version(tf) < 2, reason="needs tf2")
+@pytest.mark.parametrize("block_size", [2, 4, T, 32])
+def test_blockwise_attention_causal_matches_subsequent_mask(block_size):
+    q, k, v = [tf.random.normal((B, 3, T, 4)) for _ in range(3)]
+    # Every query can see the first key, so no row is fully masked
+    mask = tf.reshape(tf.sequence_mask([T, 4, 1, 1, 2, T], T, dtype=tf.int32), [B, 1, 1, T])
+    subsequent = tf.reshape(tf.linalg.band_part(tf.ones((T, T), dtype=tf.int32), -1, 0), [1, 1, T, T])
+    for m in (None, mask):
+        res = SeqBlockwiseDotProductAttention(0.0, block_size=block_size, causal=True)((q, k, v, m))
+        gold_mask = subsequent if m is None else subsequent * m
+        gold = SeqScaledDotProductAttention(0.0)((q, k, v, gold_mask))
+        np.testing.assert_allclose(res.numpy(), gold.numpy(), rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.skipif(get_version(tf) < 2, reason="needs tf2")
+def test_blockwise_attention_causal_rejects_query_mask():
+    q, k, v = [tf.random.normal((B, 3, T, 4)) for _ in range(3)]
+    subsequent = tf.reshape(tf.linalg.band_part(tf.ones((T, T), dtype=tf.int32), -1, 0), [1, 1, T, T])
+    with pytest.raises(ValueError):
+        SeqBlockwiseDotProductAttention(0.0, block_size=4, causal=True)((q, k, v, subsequent))
+
+
+@pytest.mark.skipif(get_version(tf) < 2, reason="needs tf2")
+def test_time_mask_stack_causal_blocks_match_subsequent_mask(inputs):
+    full = TransformerEncoderStackWithTimeMask(2, H, 0.0, layers=2)
+    blocked = TransformerEncoderStackWithTimeMask(2, H, 0.0, layers=2, block_size=4)
+    lengths = tf.fill([B], T)
+    gold = full((inputs, lengths))
+    blocked((inputs, lengths))
+    blocked.set_weights(full.get_weights())
+    assert blocked.causal and not full.causal
+    np.testing.assert_allclose(blocked((inputs, lengths)).numpy(), gold.numpy(), rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.skipif(get_version(tf) < 2, reason="needs tf2")
+def test_relative_position_edges_static_and_dynamic():
+    edges = relative_position_edges(T, 3)
+    assert edges is relative_position_edges(T, 3)
+    assert edges[0, 0] == 3 and edges[0, -1] == 6 and edges[-1, 0] == 0 and edges[2, 4] == 5
+    attn = MultiHeadedRelativeAttention(2, H, 3, dropout=0.0)
+    for static, dynamic in zip(attn.make_rpr(T), attn.make_rpr(tf.constant(T))):
+        np.testing.assert_allclose(static.numpy(), dynamic.numpy())
+
+
+@pytest.mark.skipif(get_version(tf) < 2, reason="needs tf2")
+@pytest.mark.parametrize("scale", [False, True])
+def test_relative_attention_tables_match_lookups(scale):
+    attn = MultiHeadedRelativeAttention(2, H, 3, dropout=0.0, scale=scale)
+    q, k, v = [tf.random.normal((B, 2, T, H // 2)) for _ in range(3)]
+    for seq_len in (T, tf.constant(T)):
+        rpr_key, rpr_value = attn.make_rpr_tables(seq_len)
+        res = attn.attn_fn((q, k, v, rpr_key, rpr_value, None))
+        gold = attn.attn_fn((q, k, v, *attn.make_rpr(seq_len), None))
+        np.testing.assert_allclose(res.numpy(), gold.numpy(), rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.skipif(get_version(tf) < 2, reason="needs tf2")
+def test_attention_head_projections_match_dense(inputs):
+    attn = MultiHeadedAttention(3, H, dropout=0.0, d_k=5)
+    memory = tf.random.normal((B, 4, H))
+    res = attn((inputs, memory, memory, None))
+
+    def split(w, x):
+        return tf.transpose(tf.reshape(w(x), [B, -1, 3, 5]), [0, 2, 1, 3])
+
+    x = attn.attn_fn((split(attn.w_Q, inputs), split(attn.w_K, memory), split(attn.w_V, memory), None))
+    gold = attn.w_O(tf.reshape(tf.transpose(x, [0, 2, 1, 3]), [B, -1, 15]))
+    assert res.shape == (B, T, 15)
+    np.testing.assert_allclose(res.numpy(), gold.numpy(), rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.skipif(get_version(tf) < 2, reason="needs tf2")
+def test_self_attention_concats_qkv_once_per_trace(inputs):
+    attn = MultiHeadedAttention(3, H, dropout=0.0)
+    gold = attn((inputs, inputs, inputs, None))
+    twice = tf.function(lambda x: [attn((x, x, x, None)) for _ in range(2)])
+    graph = twice.get_concrete_function(inputs).graph
+    # One concat for the kernels and one for the biases, shared by both calls
+    assert sum(op.type == "ConcatV2" for op in graph.get_operations()) == 2
+    for res in twice(inputs):
+        np.testing.assert_allclose(res.numpy(), gold.numpy(), rtol=1e-5, atol=1e-5)
+    assert len(attn.trainable_weights) == 8
+
+
+@pytest.mark.skipif(get_version(tf) < 2, reason="needs tf2")
+def test_decoder_reuses_projected_memory(inputs):
+    decoder = TransformerDecoderStack(H, 2, 0.0, layers=2)
+    memory = tf.random.normal((B, 4, H))
+    src_mask = tf.reshape(tf.sequence_mask([4, 2, 1, 4, 3, 4], 4, dtype=tf.int32), [B, 1, 1, 4])
+    tgt_mask = subsequent_mask(T)
+    gold = decoder((inputs, memory, src_mask, tgt_mask))
+    cache = {}
+    for _ in range(2):
+        res = decoder((inputs, memory, src_mask, tgt_mask), cache=cache)
+        np.testing.assert_allclose(res.numpy(), gold.numpy(), rtol=1e-5, atol=1e-5)
+    assert sorted(cache) == [0, 1] and all("src_kv" in layer_cache for layer_cache in cache.values())
+
+
+@pytest.mark.skipif(get_version(tf) < 2, reason="needs tf2")
+@pytest.mark.parametrize("jit_compile", [False, True])
+def test_transformer_encoder_stack(inputs, jit_compile):
+    encoder = TransformerEncoderStack(2, H, 0.5, layers=2, jit_compile=jit_compile)
+    # Checkpoints are restored by name, so the layer norms keep their Keras names
+    assert encoder.ln.name.startswith("layer_normalization")
+    mask = tf.reshape(tf.sequence_mask([T, 4, 1, 5, 2, T], T, dtype=tf.int32), [B, 1, 1, T])
+    try:
+        SET_TRAIN_FLAG(False)
+        res = encoder((inputs, mask))
+        x = inputs
+        for layer in encoder.encoders:
+            x = layer((x, mask))
+        np.testing.assert_allclose(res.numpy(), encoder.ln(x).numpy(), rtol=1e-5, atol=1e-5)
+        SET_TRAIN_FLAG(True)
+        assert not np.allclose(encoder((inputs, mask)).numpy(), res.numpy())
+    finally:
+        SET_TRAIN_FLAG(False)
+
+
+@pytest.mark.skipif(get_version(tf) < 2, reason="needs tf2")
+def test_transformer_encoder_stack_xla_is_opt_in():
+    assert not TransformerEncoderStack(2, H, 0.5)._call._jit_compile
+    try:
+        set_tf_jit_compile(True)
+        assert TransformerEncoderStack(2, H, 0.5)._call._jit_compile
+        assert not TransformerEncoderStack(2, H, 0.5, jit_compile=False)._call._jit_compile
+    finally:
+        set_tf_jit_compile(False)
+
+
+@pytest.mark.skipif(get_version(tf) < 2, reason="needs tf2")
+def test_subsequent_mask_static_and_dynamic():
+    static = subsequent_mask(T)
+    np.testing.assert_array_equal(static.numpy(), subsequent_mask(tf.constant(T)).numpy())
+    np.testing.assert_array_equal(static.numpy()[0, 0], np.tril(np.ones((T, T))))
+
+
+@pytest.mark.skipif(get_version(tf) < 2, reason="needs tf2")
+@pytest.mark.parametrize("gated", [False, True])
+def test_ffn(inputs, gated):
+    ffn = FFN(H, 0.5, "swish", 16, gated=gated)
+    try:
+        SET_TRAIN_FLAG(False)
+        res = ffn(inputs)
+        x = tf.nn.swish(ffn.expansion(inputs))
+        if gated:
+            x *= ffn.expansion_v(inputs)
+        np.testing.assert_allclose(res.numpy(), ffn.squeeze(x).numpy(), rtol=1e-5, atol=1e-5)
+        SET_TRAIN_FLAG(True)
+        assert not np.allclose(ffn(inputs).numpy(), res.numpy())
+    finally:
+        SET_TRAIN_FLAG(False)
+
+
+@pytest.mark.skipif(get_version(tf) < 2, reason="needs tf2")
+@pytest.mark.parametrize(
+    "attn_cls", [LuongDotProductAttention, ScaledDotProductAttention, LuongGeneralAttention, BahdanauAttention]
+)
+def test_vector_sequence_attention_masks_keys(attn_cls):
+    attn = attn_cls(H)
+    query = tf.random.normal((B, H))
+    keys = tf.random.normal((B, T, H))
+    lengths = tf.constant([T, 4, 1, 2, 5, T])
+    a = attn._attention(query, keys, tf.sequence_mask(lengths, T)).numpy()
+    np.testing.assert_allclose(a.sum(-1), np.ones(B), rtol=1e-5)
+    assert np.all(a[np.arange(T)[None, :] >= lengths.numpy()[:, None]] == 0)
+    np.testing.assert_allclose(
+        attn._attention(query, keys, None).numpy(), attn._attention(query, keys, tf.ones((B, T))).numpy()
+    )
+
+
+@pytest.mark.skipif(get_version(tf) < 2, reason="needs tf2")
+def test_scaled_dot_product_vector_attention():
+    query = tf.random.normal((B, H))
+    keys = tf.random.normal((B, T, H))
+    gold = tf.nn.softmax(tf.einsum("bth,bh->bt", keys, query) / math.sqrt(H), axis=-1)
+    res = ScaledDotProductAttention(H)._attention(query, keys, None)
+    np.testing.assert_allclose(res.numpy(), gold.numpy(), rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.skipif(get_version(tf) < 2, reason="needs tf2")
+def test_bahdanau_attention_scores():
+    attn = BahdanauAttention(H)
+    query = tf.random.normal((B, H))
+    keys = tf.random.normal((B, T, H))
+    res = attn._attention(query, attn.project_keys(keys), None)
+    z = tf.nn.tanh(tf.expand_dims(attn.W_a(query), 1) + attn.E_a(keys))
+    gold = tf.nn.softmax(tf.squeeze(attn.v(z), -1), axis=-1)
+    np.testing.assert_allclose(res.numpy(), gold.numpy(), rtol=1e-5, atol=1e-6)
+    assert attn.v.kernel.name == f"{attn.v.name}/kernel:0"
+
+
+@pytest.mark.skipif(get_version(tf) < 2, reason="needs tf2")
+def test_vector_sequence_attention_caches_projected_keys():
+    attn = BahdanauAttention(H)
+    keys = tf.random.normal((B, T, H))
+    mask = tf.sequence_mask([T, 4, 1, 2, 5, T], T)
+    cache = {}
+    for _ in range(2):
+        query = tf.random.normal((B, H))
+        res = attn((query, keys, keys, mask), cache=cache)
+        np.testing.assert_allclose(res.numpy(), attn((query, keys, keys, mask)).numpy(), rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(cache["keys"].numpy(), attn.E_a(keys).numpy())
+
+
+@pytest.mark.skipif(get_version(tf) < 2, reason="needs tf2")
+@pytest.mark.parametrize("attn_cls", [LuongDotProductAttention, BahdanauAttention])
+def test_vector_sequence_attention_update(attn_cls):
+    attn = attn_cls(H)
+    query = tf.random.normal((B, H))
+    values = tf.random.normal((B, T, H))
+    a = tf.nn.softmax(tf.random.normal((B, T)), axis=-1)
+    res = attn._update(a, query, values)
+    gold = attn.W_c(tf.concat([tf.einsum("bt,bth->bh", a, values), query], -1))
+    if attn_cls is LuongDotProductAttention:
+        gold = tf.nn.tanh(gold)
+    np.testing.assert_allclose(res.numpy(), gold.numpy(), rtol=1e-5, atol=1e-5)
+    assert attn.W_c.kernel.name == f"{attn.W_c.name}/kernel:0"
+
+
+@pytest.mark.skipif(get_version(tf) < 2, reason="needs tf2")
+@pytest.mark.parametrize("jit_compile", [False, True])
+def test_layer_norm_matches_keras(inputs, jit_compile):
+    ln = LayerNormalization(epsilon=1e-6, jit_compile=jit_compile)
+    gold = tf.keras.layers.LayerNormalization(epsilon=1e-6)
+    assert ln.name.startswith("layer_normalization") and (ln._fused_call is not None) == jit_compile
+    ln(inputs)
+    gold(inputs)
+    ln.set_weights([w + 0.5 for w in ln.get_weights()])
+    gold.set_weights(ln.get_weights())
+    np.testing.assert_allclose(ln(inputs).numpy(), gold(inputs).numpy(), rtol=1e-5, atol=1e-5)